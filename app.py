@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, json, send_from_directory, make_response
+from flask import Flask, Response, request, json, send_from_directory, make_response
 from peewee import DoesNotExist
 
 import argparse
@@ -10,9 +10,11 @@ import flask_limiter.util
 import logging
 import os
 
+import src.callbacks as callbacks
 import src.files as files
 from src.models import init_db, Job
-from src.commands import init_commands
+from src.queues import init_queue, QueueError
+from src.commands import init_commands, validate_command
 from src.schedule import init_app_scheduler
 
 # The user defined command definitions are imported here
@@ -29,10 +31,14 @@ app = Flask(__name__)
 
 db = None
 
+job_queue = None
+
 log = app.logger
 
 
 def init():
+    global job_queue
+
     # adjust the global log level
     if app.config["ENV"] != "production":
         log.setLevel(logging.DEBUG)
@@ -41,10 +47,14 @@ def init():
     # Setup all necessary directories (needs config)
     files.init_file_structure(app_config=app.config, proj_dir=project_dir, logger=app.logger)
     # Setup the database (needs file structure, config)
-    init_db(db_path=files.db_path(), logger=log)
+    init_db(db_path=files.db_path(), logger=log, db_url=app.config.get("DB_URL"))
+    # Setup the queue handing jobs to the executors (needs db, config)
+    job_queue = init_queue(app_config=app.config, app_logger=app.logger)
+    # Setup the delivery of completion callbacks (needs config)
+    callbacks.init_callbacks(app_config=app.config, app_logger=app.logger)
     # Setup the commands module (needs config)
     init_commands(app_config=app.config, app_logger=app.logger, commands_list=commands)
-    # Setup the scheduler and directly start it (needs db, commands)
+    # Setup the scheduler and directly start it (needs db, queue, commands)
     scheduler = init_app_scheduler(app_config=app.config, app_logger=app.logger)
     scheduler.start()
 
@@ -99,35 +109,78 @@ init()
 limiter = _init_rate_limiter()
 
 
+def validate_run_request(data: dict):
+    """
+    Check a parsed /run request, raising a KeyError, TypeError or
+    ValueError if it is invalid. Shared with the asynchronous mode.
+    """
+    validate_command(data["command"]["name"], data["command"]["options"])
+    if "callback" in data and not callbacks.is_allowed(data["callback"]):
+        raise ValueError("Callback url not allowed: {}".format(data["callback"]))
+
+
+def submit_job(job: Job, data: dict):
+    # delete any text or additional arguments before saving the request
+    for k in list(data.keys()):
+        if k not in ["command", "callback"]:
+            del data[k]
+    job.request = json.dumps(data)
+    job.save(force_insert=True)
+    try:
+        job_queue.enqueue(job)
+    except QueueError:
+        # Nothing would ever run the job, so it should not remain either
+        job.delete_instance()
+        os.remove(files.upload_path(job))
+        raise
+
+
+def job_is_finished(job_id) -> bool:
+    # A job deleted in the meantime will not produce more output either
+    current = Job.get_or_none(Job.id == job_id)
+    return current is None or current.is_finished()
+
+
 @app.route("/run", methods=["POST"])
 @limiter.limit(_rate_limit_for_job_request)
 def handle_run():
 
     job = Job(status="NEW")
     filename = files.upload_path(job)
-    log.debug("Writing to: " + filename)
 
+    # Parse and validate the request before anything reaches the disk
+    # or the queue, so that invalid requests are rejected directly.
+    try:
+        if request.mimetype == "multipart/form-data":
+            file = request.files['file']
+            data = json.loads(request.form.get("data"))
+        else:
+            data = json.loads(request.get_data())
+            text = data["text"]
+            if not isinstance(text, str):
+                raise TypeError("'text' must be a string.")
+        validate_run_request(data)
+    except (KeyError, TypeError, ValueError) as e:
+        return {"message": "Invalid request: {}".format(e)}, 400
+
+    log.debug("Writing to: " + filename)
     if request.mimetype == "multipart/form-data":
         # Handle a run command with accompanying file upload
         # Write the file to disk and save the json formatted
         # command definition for later processing
-        file = request.files['file']
         file.save(filename)
-        data = json.loads(request.form.get("data"))
     else:
         # Handle a run command with text input. Save the text
         # to a file and save the command definition for later
         # processing
-        data = json.loads(request.get_data())
         with open(filename, mode="w", encoding="UTF-8") as file:
-            file.write(data["text"])
+            file.write(text)
 
-    # delete any text or additional arguments before saving the request
-    for k in list(data.keys()):
-        if k not in ["command"]:
-            del data[k]
-    job.request = json.dumps(data)
-    job.save(force_insert=True)
+    try:
+        submit_job(job, data)
+    except QueueError as e:
+        log.error(str(e))
+        return {"message": "The job could not be queued, please try again later."}, 503
     return {"job": job.id}
 
 
@@ -136,6 +189,33 @@ def handle_result(filename):
     return send_from_directory(files.downloads_dir(), filename)
 
 
+@app.route("/follow/<jobId>.<stream>")
+def handle_follow(jobId, stream):
+    try:
+        job = Job.get_by_id(jobId)
+    except DoesNotExist:
+        return {"message": "A job with this id does not exist."}, 404
+
+    if stream == "stdout":
+        path = files.result_path_stdout(job)
+    elif stream == "stderr":
+        path = files.result_path_stderr(job)
+    else:
+        return {"message": "Not a result stream: {}".format(stream)}, 404
+
+    # Check the offset here, errors in the stream would truncate the response
+    offset = request.args.get("offset", default=0, type=int)
+    if offset < 0:
+        return {"message": "The offset must not be negative: {}".format(offset)}, 400
+
+    chunks = files.follow_file(path,
+                               is_finished=lambda: job_is_finished(job.id),
+                               offset=offset,
+                               interval=app.config.get("INTERVAL_FOLLOW_POLL"),
+                               max_duration=app.config.get("TIME_FOLLOW_MAX"))
+    return Response(chunks, mimetype="application/octet-stream")
+
+
 @app.route("/status/<jobId>")
 def handle_status(jobId):
     try:
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# An asynchronous (ASGI) mode for the app's I/O bound routes. Waiting for
+# a request body, a result file or new output of a job does not tie up a
+# thread here, so a single process can hold thousands of connections.
+#
+# The routes behave like their counterparts in app.py and share its
+# config, database, queue and scheduler, which are set up on import of
+# the app module. Serving needs an ASGI server, e.g. uvicorn:
+#
+#   pip install uvicorn
+#   ./asgi.py --port 8080
+
+import argparse
+import asyncio
+import os
+import re
+import tempfile
+
+import limits
+import limits.storage
+import limits.strategies
+from flask import json
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
+from werkzeug.security import safe_join
+
+import src.files as files
+from app import app, submit_job, validate_run_request, job_is_finished
+from src.models import Job
+from src.queues import QueueError
+
+log = app.logger
+
+# Request bodies larger than this are spooled to disk while reading
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+# The limiter only keeps a weak reference to its storage
+rate_limit_storage = limits.storage.MemoryStorage()
+
+rate_limiter = limits.strategies.MovingWindowRateLimiter(rate_limit_storage)
+
+# The pending or last status checks of followed jobs by id as a string,
+# as pairs of the check's start time and its future.
+status_checks = {}
+
+# The number of clients following each job by id as a string, so that a
+# job's status check is dropped once its last follower is gone.
+followers = {}
+
+
+class Request:
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+    def query_int(self, name: str, default: int) -> int:
+        for pair in self.scope.get("query_string", b"").decode("latin-1").split("&"):
+            key, _, value = pair.partition("=")
+            if key == name:
+                try:
+                    return int(value)
+                except ValueError:
+                    return default
+        return default
+
+    def client_key(self) -> str:
+        # The same identification of users as app._init_rate_limiter()
+        forwarded = self.headers.get("x-forwarded-for")
+        if app.config.get("RATE_LIMITING_USE_X_FORWARDED_FOR") and forwarded:
+            # Like flask_limiter.util.get_ipaddr(), the first address
+            return forwarded.split(",")[0].strip()
+        client = self.scope.get("client")
+        return client[0] if client else "127.0.0.1"
+
+    async def wait_for_disconnect(self):
+        while (await self.receive())["type"] != "http.disconnect":
+            pass
+
+    async def body(self):
+        """
+        :return: The request body as a file object, spooled to disk if large.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+        more_body = True
+        while more_body:
+            message = await self.receive()
+            body.write(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body.seek(0)
+        return body
+
+
+async def send_json(send, data: dict, status=200):
+    content = json.dumps(data).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+async def start_stream(send, content_type: str, content_length=None, extra_headers=()):
+    headers = [(b"content-type", content_type.encode())]
+    if content_length is not None:
+        headers.append((b"content-length", str(content_length).encode()))
+    headers.extend(extra_headers)
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+
+def run_blocking(func, *args):
+    # Database and file system calls run on the default thread pool
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def is_finished(job_id) -> bool:
+    # All followers of a job share a single status check per interval
+    loop = asyncio.get_event_loop()
+    check = status_checks.get(job_id)
+    if check is None or loop.time() - check[0] >= app.config.get("INTERVAL_FOLLOW_POLL"):
+        check = (loop.time(), run_blocking(job_is_finished, job_id))
+        status_checks[job_id] = check
+    return await check[1]
+
+
+async def handle_run(request: Request, send):
+    for limit in limits.parse_many(app.config.get("RATE_LIMIT_JOB_REQUESTS")):
+        if not rate_limiter.hit(limit, "run", request.client_key()):
+            return await send_json(send, {"limit": str(limit)}, status=429)
+
+    body = await request.body()
+    try:
+        job, data = await run_blocking(_save_run_request, request.headers.get("content-type", ""), body)
+    except (KeyError, TypeError, ValueError) as e:
+        return await send_json(send, {"message": "Invalid request: {}".format(e)}, status=400)
+    finally:
+        body.close()
+    try:
+        await run_blocking(submit_job, job, data)
+    except QueueError as e:
+        log.error(str(e))
+        return await send_json(send, {"message": "The job could not be queued, please try again later."}, status=503)
+    await send_json(send, {"job": job.id})
+
+
+def _save_run_request(content_type: str, body) -> (Job, dict):
+    # Mirrors app.handle_run(), validating before anything is saved
+    job = Job(status="NEW")
+    mimetype, options = parse_options_header(content_type)
+    if mimetype == "multipart/form-data":
+        content_length = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        _, form, uploads = FormDataParser().parse(body, mimetype, content_length, options)
+        file = uploads["file"]
+        data = json.loads(form.get("data"))
+        validate_run_request(data)
+        file.save(files.upload_path(job))
+    else:
+        data = json.loads(body.read())
+        text = data["text"]
+        if not isinstance(text, str):
+            raise TypeError("'text' must be a string.")
+        validate_run_request(data)
+        with open(files.upload_path(job), mode="w", encoding="UTF-8") as file:
+            file.write(text)
+    return job, data
+
+
+async def handle_status(request: Request, send, job_id: str):
+    job = await run_blocking(lambda: Job.get_or_none(Job.id == job_id))
+    if job is None:
+        return await send_json(send, {"message": "A job with this id does not exist."}, status=404)
+    await send_json(send, {"id": job.id, "status": job.status, "message": job.message})
+
+
+async def handle_result(request: Request, send, filename: str):
+    path = safe_join(files.downloads_dir(), filename)
+    if path is None or not await run_blocking(os.path.isfile, path):
+        return await send_json(send, {"message": "Not found."}, status=404)
+
+    if app.use_x_sendfile:
+        # Like Flask, leave sending the file to the web server in front
+        await start_stream(send, "application/octet-stream", 0,
+                           extra_headers=[(b"x-sendfile", os.path.abspath(path).encode())])
+        return await send({"type": "http.response.body", "body": b""})
+
+    file = await run_blocking(open, path, "rb")
+    try:
+        await start_stream(send, "application/octet-stream", os.fstat(file.fileno()).st_size)
+        while True:
+            chunk = await run_blocking(file.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        file.close()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def handle_follow(request: Request, send, job_id: str, stream: str):
+    job = await run_blocking(lambda: Job.get_or_none(Job.id == job_id))
+    if job is None:
+        return await send_json(send, {"message": "A job with this id does not exist."}, status=404)
+    if stream == "stdout":
+        path = files.result_path_stdout(job)
+    elif stream == "stderr":
+        path = files.result_path_stderr(job)
+    else:
+        return await send_json(send, {"message": "Not a result stream: {}".format(stream)}, status=404)
+
+    offset = request.query_int("offset", 0)
+    if offset < 0:
+        return await send_json(send, {"message": "The offset must not be negative: {}".format(offset)}, status=400)
+
+    # Like files.follow_file(), but waiting without holding a thread and
+    # stopping as soon as the client is gone.
+    follower = files.FileFollower(path, offset=offset, chunk_size=CHUNK_SIZE)
+    key = str(job.id)
+    followers[key] = followers.get(key, 0) + 1
+    disconnected = asyncio.ensure_future(request.wait_for_disconnect())
+    deadline = asyncio.get_event_loop().time() + app.config.get("TIME_FOLLOW_MAX")
+    try:
+        await start_stream(send, "application/octet-stream")
+        while not disconnected.done() and asyncio.get_event_loop().time() < deadline:
+            finished = await is_finished(key)
+            chunk = await run_blocking(follower.read)
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            elif finished:
+                break
+            else:
+                await asyncio.sleep(app.config.get("INTERVAL_FOLLOW_POLL"))
+    finally:
+        disconnected.cancel()
+        follower.close()
+        followers[key] -= 1
+        if not followers[key]:
+            del followers[key]
+            status_checks.pop(key, None)
+    await send({"type": "http.response.body", "body": b""})
+
+
+routes = [
+    ("POST", re.compile(r"^/run$"), handle_run),
+    ("GET", re.compile(r"^/status/(?P<job_id>[^/]+)$"), handle_status),
+    ("GET", re.compile(r"^/result/(?P<filename>.+)$"), handle_result),
+    ("GET", re.compile(r"^/follow/(?P<job_id>[^/]+)\.(?P<stream>[^./]+)$"), handle_follow),
+]
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    request = Request(scope, receive)
+    for method, pattern, handler in routes:
+        match = pattern.match(request.path)
+        if match and request.method == method:
+            try:
+                return await handler(request, send, **match.groupdict())
+            except Exception as e:
+                log.error("Error when handling {} {}: {}".format(request.method, request.path, e))
+                raise
+    await send_json(send, {"message": "Not found."}, status=404)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Start the demoapp server in asynchronous mode.")
+    parser.add_argument("--port", type=int, default=8080, help="The local port to expose the api at.")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The asynchronous mode needs an ASGI server, install one with: pip install uvicorn")
+
+    uvicorn.run(application, port=args.port, host="0.0.0.0", log_level="warning")
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# A benchmark for the submit -> execute -> fetch path of the app.
+#
+# Starts a local server with its own temporary data directory, then runs
+# jobs through /run, /status and /result for every combination of the
+# given commands, concurrency levels and input sizes. Results are printed,
+# compared to the last stored run with the same parameters and appended
+# to a JSON lines file.
+#
+# With --connections the connection capacity of the server is measured
+# instead: the given numbers of clients each hold a /follow connection
+# open, while the latency of /status requests is probed. Comparing the
+# results of --server wsgi and --server asgi shows what the asynchronous
+# mode gains.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+project_dir = os.path.dirname(os.path.abspath(__file__))
+
+FINAL_STATUSES = ["SUCCESS", "FAILED"]
+
+# The config used by the benchmarked server in addition to the default
+# and production config.
+SERVER_CONFIG_TEMPLATE = """
+DB_FILE="{data_dir}/db.sqlite"
+DIR_UPLOADS="{data_dir}/uploads"
+DIR_DOWNLOADS="{data_dir}/downloads"
+INTERVAL_JOB_START={job_interval}
+EXECUTE_JOBS={execute_jobs}
+RATE_LIMIT_JOB_REQUESTS="1000000/second"
+"""
+
+# The scripts starting the server in each mode
+SERVER_ENTRY_POINTS = {
+    "wsgi": "app.py",
+    "asgi": "asgi.py",
+}
+
+# How long to wait for the server to come up (in seconds)
+SERVER_START_TIMEOUT = 10.0
+
+
+def percentile(values: [float], p: float) -> float:
+    # The nearest-rank percentile, values need not be sorted
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Server:
+    """
+    The app running in a separate process on a free local port.
+    """
+
+    def __init__(self, mode: str, job_interval: float, execute_jobs=True):
+        self.entry_point = SERVER_ENTRY_POINTS[mode]
+        self.execute_jobs = execute_jobs
+        self.data_dir = tempfile.mkdtemp(prefix="demoapp-benchmark")
+        self.db_path = os.path.join(self.data_dir, "db.sqlite")
+        self.port = self._free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        self.job_interval = job_interval
+        self.process = None
+
+    def start(self):
+        config_path = os.path.join(self.data_dir, "benchmark.cfg")
+        with open(config_path, mode="w", encoding="UTF-8") as file:
+            file.write(SERVER_CONFIG_TEMPLATE.format(data_dir=self.data_dir,
+                                                     job_interval=self.job_interval,
+                                                     execute_jobs=self.execute_jobs))
+
+        env = dict(os.environ, FLASK_ENV="production", FLASK_APP_CONFIG=config_path)
+        script = os.path.join(project_dir, self.entry_point)
+        self.process = subprocess.Popen([sys.executable, script, "--port", str(self.port)],
+                                        cwd=project_dir,
+                                        env=env,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(self.url + "/status/none")
+            except urllib.error.HTTPError:
+                # Any answer, even 404, means the server is up
+                return
+            except urllib.error.URLError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Server did not start within {}s.".format(SERVER_START_TIMEOUT))
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def resources(self) -> dict:
+        # The server's thread count and memory, only available on Linux
+        usage = {"threads": None, "rss_kb": None}
+        try:
+            with open("/proc/{}/status".format(self.process.pid)) as file:
+                for line in file:
+                    if line.startswith("Threads:"):
+                        usage["threads"] = int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        usage["rss_kb"] = int(line.split()[1])
+        except OSError:
+            pass
+        return usage
+
+    @staticmethod
+    def _free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+
+class LockProbe(threading.Thread):
+    """
+    Measures SQLite contention by repeatedly timing how long it takes to
+    acquire the database's write lock while the benchmark is running.
+    """
+
+    def __init__(self, db_path: str, interval: float):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.interval = interval
+        self.waits = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        connection = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        try:
+            while not self._stopped.wait(self.interval):
+                start = time.monotonic()
+                connection.execute("BEGIN IMMEDIATE")
+                self.waits.append(time.monotonic() - start)
+                connection.execute("ROLLBACK")
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _request(url: str, data=None) -> bytes:
+    with urllib.request.urlopen(url, data=data) as response:
+        return response.read()
+
+
+def run_job(base_url: str, command: str, text: str, poll_interval: float, timeout: float) -> dict:
+    start = time.monotonic()
+    request = {"text": text, "command": {"name": command, "options": []}}
+    job_id = json.loads(_request(base_url + "/run", data=json.dumps(request).encode("utf-8")))["job"]
+    submitted = time.monotonic()
+
+    polls = 0
+    while True:
+        status = json.loads(_request("{}/status/{}".format(base_url, job_id)))
+        polls += 1
+        if status["status"] in FINAL_STATUSES:
+            break
+        if time.monotonic() - start > timeout:
+            raise TimeoutError("Job {} did not finish within {}s.".format(job_id, timeout))
+        time.sleep(poll_interval)
+
+    output = _request("{}/result/{}.stdout".format(base_url, job_id))
+    done = time.monotonic()
+    return {
+        "status": status["status"],
+        "submit": submitted - start,
+        "end_to_end": done - start,
+        "polls": polls,
+        "output_bytes": len(output),
+    }
+
+
+def run_scenario(server: Server, scenario: dict, args) -> dict:
+    text = "x" * scenario["size"]
+    results = []
+    errors = 0
+
+    probe = LockProbe(server.db_path, interval=args.probe_interval)
+    probe.start()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=scenario["concurrency"]) as executor:
+        futures = [executor.submit(run_job, server.url, scenario["command"], text, args.poll_interval, args.timeout)
+                   for _ in range(scenario["jobs"])]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors += 1
+                print("Job error: {}".format(e), file=sys.stderr)
+    duration = time.monotonic() - start
+    probe.stop()
+
+    end_to_end = [result["end_to_end"] for result in results]
+    submit = [result["submit"] for result in results]
+    return {
+        "duration": duration,
+        "throughput": len(results) / duration,
+        "errors": errors,
+        "failed_jobs": sum(1 for result in results if result["status"] != "SUCCESS"),
+        "p50": percentile(end_to_end, 50),
+        "p95": percentile(end_to_end, 95),
+        "p99": percentile(end_to_end, 99),
+        "submit_p95": percentile(submit, 95),
+        "polls_per_job": sum(result["polls"] for result in results) / max(1, len(results)),
+        "lock_wait_p50": percentile(probe.waits, 50),
+        "lock_wait_p99": percentile(probe.waits, 99),
+        "lock_wait_max": max(probe.waits, default=float("nan")),
+    }
+
+
+async def _http_get(port: int, path: str) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write("GET {} HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n".format(path).encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def _measure_capacity(server: Server, job_id: str, connections: int, args) -> dict:
+    request = "GET /follow/{}.stdout HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".format(job_id).encode()
+    # Limit simultaneous connection attempts, to measure how many connections
+    # can be held rather than how large a burst the listen backlog takes.
+    connecting = asyncio.Semaphore(100)
+
+    async def hold():
+        async with connecting:
+            _, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", server.port), args.timeout)
+            writer.write(request)
+            await writer.drain()
+            return writer
+
+    start = time.monotonic()
+    held = await asyncio.gather(*[hold() for _ in range(connections)], return_exceptions=True)
+    writers = [writer for writer in held if isinstance(writer, asyncio.StreamWriter)]
+    connect_duration = time.monotonic() - start
+    await asyncio.sleep(args.settle_time)
+
+    latencies = []
+    probe_failures = 0
+    for _ in range(args.probes):
+        start = time.monotonic()
+        try:
+            if await asyncio.wait_for(_http_get(server.port, "/status/" + job_id), args.timeout) != 200:
+                raise ValueError("Unexpected status")
+            latencies.append(time.monotonic() - start)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            probe_failures += 1
+    usage = server.resources()
+
+    for writer in writers:
+        writer.close()
+    return {
+        "held": len(writers),
+        "failed": connections - len(writers),
+        "connect_duration": connect_duration,
+        "status_p50": percentile(latencies, 50),
+        "status_p95": percentile(latencies, 95),
+        "status_failures": probe_failures,
+        "server_threads": usage["threads"],
+        "server_rss_kb": usage["rss_kb"],
+    }
+
+
+def run_capacity_scenario(server: Server, scenario: dict, args) -> dict:
+    # The server does not execute jobs, so that the job stays unfinished
+    # and every /follow connection is held open.
+    request = {"text": "", "command": {"name": "true", "options": []}}
+    job_id = json.loads(_request(server.url + "/run", data=json.dumps(request).encode("utf-8")))["job"]
+    return asyncio.run(_measure_capacity(server, job_id, scenario["connections"], args))
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _load_previous(path: str) -> [dict]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding="UTF-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _print_result(scenario: dict, metrics: dict, previous: dict):
+    print("{server} {command} concurrency={concurrency} size={size} jobs={jobs}".format(**scenario))
+    print("  throughput: {:8.2f} jobs/s, errors: {}, failed jobs: {}".format(
+        metrics["throughput"], metrics["errors"], metrics["failed_jobs"]))
+    print("  latency:    p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  (submit p95 {:.3f}s, {:.1f} polls/job)".format(
+        metrics["p50"], metrics["p95"], metrics["p99"], metrics["submit_p95"], metrics["polls_per_job"]))
+    print("  db lock:    p50 {:.4f}s  p99 {:.4f}s  max {:.4f}s".format(
+        metrics["lock_wait_p50"], metrics["lock_wait_p99"], metrics["lock_wait_max"]))
+    if previous:
+        def change(key):
+            return _format_change(previous["metrics"][key], metrics[key], relative=True)
+        print("  compared to {} ({}): throughput {}, p95 {}".format(
+            previous["revision"], previous["time"], change("throughput"), change("p95")))
+
+
+def _print_capacity_result(scenario: dict, metrics: dict, previous: dict):
+    print("{server} connections={connections}".format(**scenario))
+    print("  held:       {} connections, {} failed, connecting took {:.2f}s".format(
+        metrics["held"], metrics["failed"], metrics["connect_duration"]))
+    print("  status:     p50 {:.3f}s  p95 {:.3f}s  ({} failed)".format(
+        metrics["status_p50"], metrics["status_p95"], metrics["status_failures"]))
+    print("  server:     {} threads, {} kB RSS".format(metrics["server_threads"], metrics["server_rss_kb"]))
+    if previous:
+        print("  compared to {} ({}): held {:+d}, status p95 {}".format(
+            previous["revision"], previous["time"], metrics["held"] - previous["metrics"]["held"],
+            _format_change(previous["metrics"]["status_p95"], metrics["status_p95"], relative=False)))
+
+
+def _format_change(before: float, after: float, relative: bool) -> str:
+    # A change from or to a missing value, or relative to zero, is meaningless
+    if math.isnan(before) or math.isnan(after) or (relative and not before):
+        return "n/a"
+    if relative:
+        return "{:+.1f}%".format((after - before) / before * 100.0)
+    return "{:+.3f}s".format(after - before)
+
+
+def _check_commands(names: [str]):
+    # Fail right away, instead of with every job failing in the server
+    try:
+        import cmds
+    except ImportError as e:
+        raise SystemExit("Could not load the command definitions from cmds.py ({}), "
+                         "copy cmds.example.py to get started.".format(e))
+    defined = {definition.get("name") for definition in cmds.commands}
+    missing = [name for name in names if name not in defined]
+    if missing:
+        raise SystemExit("The commands {} are not defined in cmds.py, add them or pick others with --commands."
+                         .format(", ".join(missing)))
+
+
+def _raise_open_files_limit():
+    # Holding many connections needs many file descriptors in the benchmark
+    # and in the server, which inherits the limit.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the demoapp's submit -> execute -> fetch path.")
+    parser.add_argument("--server", choices=sorted(SERVER_ENTRY_POINTS), default="wsgi",
+                        help="Whether to benchmark the synchronous or the asynchronous server.")
+    parser.add_argument("--connections", default="",
+                        help="Comma separated numbers of connections to hold open. If given, the connection "
+                             "capacity is measured instead of the job path.")
+    parser.add_argument("--settle-time", type=float, default=1.0,
+                        help="Seconds to wait after opening connections before probing.")
+    parser.add_argument("--probes", type=int, default=20, help="The number of status requests to probe with.")
+    parser.add_argument("--commands", default="true,cat", help="Comma separated command names to run.")
+    parser.add_argument("--concurrency", default="1,8", help="Comma separated numbers of concurrent clients.")
+    parser.add_argument("--sizes", default="16,65536", help="Comma separated input text sizes in bytes.")
+    parser.add_argument("--jobs", type=int, default=50, help="The number of jobs per scenario.")
+    parser.add_argument("--job-interval", type=float, default=0.05,
+                        help="The server's INTERVAL_JOB_START in seconds.")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="Seconds between status requests.")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="Seconds between database lock probes.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds after which a job is given up on.")
+    parser.add_argument("--output", default=os.path.join(project_dir, "data", "benchmarks.jsonl"),
+                        help="The JSON lines file results are appended to.")
+    args = parser.parse_args()
+
+    if args.connections:
+        scenarios = [
+            {"server": args.server, "connections": int(connections)}
+            for connections in args.connections.split(",")
+        ]
+        run, print_result = run_capacity_scenario, _print_capacity_result
+        _check_commands(["true"])
+        _raise_open_files_limit()
+    else:
+        scenarios = [
+            {"server": args.server, "command": command, "concurrency": int(concurrency), "size": int(size),
+             "jobs": args.jobs, "job_interval": args.job_interval}
+            for command in args.commands.split(",")
+            for concurrency in args.concurrency.split(",")
+            for size in args.sizes.split(",")
+        ]
+        run, print_result = run_scenario, _print_result
+        _check_commands(args.commands.split(","))
+    history = _load_previous(args.output)
+    revision = _git_revision()
+
+    server = Server(args.server, job_interval=args.job_interval, execute_jobs=not args.connections)
+    server.start()
+    try:
+        records = []
+        for scenario in scenarios:
+            metrics = run(server, scenario, args)
+            previous = next((record for record in reversed(history) if record["scenario"] == scenario), None)
+            print_result(scenario, metrics, previous)
+            records.append({
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "revision": revision,
+                "scenario": scenario,
+                "metrics": metrics,
+            })
+    finally:
+        server.stop()
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, mode="a", encoding="UTF-8") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+    print("Results appended to: {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
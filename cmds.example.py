@@ -1,6 +1,11 @@
 
+import os
+import sys
+
 from src.commands import Option, FilePath
 
+project_dir = os.path.dirname(os.path.abspath(__file__))
+
 example_commands = [
     {
         "name": "date",
@@ -10,6 +15,13 @@ example_commands = [
         ],
         "timeout": 0.5,
     },
+    {
+        # Does nothing, useful to measure the app's own overhead
+        "name": "true",
+        "exec": [
+            "true"
+        ],
+    },
     {
         "name": "cat",
         "exec": [
@@ -18,6 +30,21 @@ example_commands = [
             FilePath()
         ],
         "timeout": 5.0,
+    },
+    {
+        # Like "cat", but handled by warm worker processes, see
+        # worker.example.py for the protocol they speak.
+        "name": "cat-persistent",
+        "exec": [
+            Option("numbers", to_shell="-n"),
+            FilePath()
+        ],
+        "persistent": {
+            "worker": [sys.executable, os.path.join(project_dir, "worker.example.py")],
+            "pool_size": 2,
+            "max_jobs": 100,
+        },
+        "timeout": 5.0,
     }
 ]
 
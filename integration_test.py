@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import copy
 import json
 import os
 import re
+import socketserver
+import tempfile
+import threading
 import time
 import unittest
 import warnings
 
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import BytesIO
-from peewee import DoesNotExist
+from peewee import DoesNotExist, PostgresqlDatabase
+from subprocess import TimeoutExpired
 from werkzeug.wrappers import Response
 
+import app as app_module
+import src.callbacks as callbacks
 from app import app
-from src.files import upload_path
+from asgi import application, followers, status_checks, Request
+from src.commands import Option, FilePath, worker_pools, _compile_command, _run_bounded, \
+    ResourceLimitError
+from src.files import upload_path, uploads_dir, result_path_stdout
 from src.models import Job
+from src.queues import JobQueue, RedisJobQueue, PostgresJobQueue
+from src.workers import Worker
 
 # A regex to check for uuids in different versions, but
 # not allowing the null uuid
@@ -69,6 +82,13 @@ class JobHelper:
         request["command"]["options"] = ["numbers"]
         return cls.prepare_job(request=request, save=save)
 
+    @classmethod
+    def prepare_job_with_persistent_command(cls, options=(), save=False) -> Job:
+        request = copy.deepcopy(cls.default_request)
+        request["command"]["name"] = "cat-persistent"
+        request["command"]["options"] = list(options)
+        return cls.prepare_job(request=request, save=save)
+
     @classmethod
     def prepare_job_with_invalid_command(cls, save=False) -> Job:
         request = copy.deepcopy(cls.default_request)
@@ -117,8 +137,8 @@ class RouteRunTest(ApiTest):
         assert os.path.isfile(upload_path(Job.get(Job.id == data["job"]))), "Should have created a file."
 
     def test_run_route_is_rate_limited(self):
-        # Use an invalid command for rate-limiting to not bother the scheduler
-        data = {"text": "Rate limiting test", "command": {"name": "invalid-command", "options": []}}
+        # Use a cheap command for rate-limiting to not bother the scheduler
+        data = {"text": "Rate limiting test", "command": {"name": "date", "options": []}}
 
         # Exhaust the per-second limit for testing, the last requests should error out
         last = None
@@ -137,6 +157,29 @@ class RouteRunTest(ApiTest):
         response = self.post_json("/run", data)
         assert response.status_code == 200, "Should return 200 OK after a waiting time."
 
+    def test_run_rejects_invalid_command(self):
+        uploads = set(os.listdir(uploads_dir()))
+        response = self.post_json("/run", {"text": "Some text here.", "command": {"name": "invalid", "options": []}})
+        assert response.status_code == 400, "Should return 400 for an invalid command name."
+        assert "message" in response.get_json(), "Should return a message for an invalid command name."
+        assert set(os.listdir(uploads_dir())) == uploads, "Should not write an invalid request to disk."
+
+    def test_run_rejects_invalid_options(self):
+        for options in [["-d"], ["unknown"], ["-d", "now", "-d", "now"], "-d", [1]]:
+            time.sleep(RATE_LIMITING_WAIT_TIME)
+            response = self.post_json("/run", {"text": "", "command": {"name": "date", "options": options}})
+            assert response.status_code == 400, "Should return 400 for invalid options: {}".format(options)
+
+    def test_run_rejects_incomplete_requests(self):
+        uploads_before = set(os.listdir(uploads_dir()))
+        for data in [{"text": "No command"},
+                     {"command": {"name": "date", "options": []}},
+                     {"text": 5, "command": {"name": "date", "options": []}}]:
+            time.sleep(RATE_LIMITING_WAIT_TIME)
+            response = self.post_json("/run", data)
+            assert response.status_code == 400, "Should return 400 for an incomplete request: {}".format(data)
+        assert set(os.listdir(uploads_dir())) == uploads_before, "Should not write invalid requests to disk."
+
     def todo_test_uploading_zero_content_file_errors(self):
         pass
 
@@ -246,6 +289,63 @@ class RouteResultTest(ApiTest):
         response = self.app.get(self._route(job.id, stderr=True))
         self._assert_empty_ok(response)
 
+    def test_scheduled_persistent_job_result(self):
+        plain_job = JobHelper.prepare_job_with_simple_option(save=True)
+        job = JobHelper.prepare_job_with_persistent_command(options=["numbers"], save=True)
+        time.sleep(2 * JOB_COMPLETION_TIME)
+
+        assert Job.get_by_id(job.id).status == "SUCCESS", "Should succeed with a persistent command."
+        response = self.app.get(self._route(job.id))
+        assert response.get_data() == self.app.get(self._route(plain_job.id)).get_data(),\
+            "Should return the same output from a persistent worker as from the command."
+        response = self.app.get(self._route(job.id, stderr=True))
+        self._assert_empty_ok(response)
+
+    def test_persistent_workers_are_reused(self):
+        pool = worker_pools["cat-persistent"]
+        pool.warm()
+        pids_before = set(pool.idle_pids())
+
+        jobs = [JobHelper.prepare_job_with_persistent_command(save=True) for _ in range(3)]
+        time.sleep(3 * JOB_COMPLETION_TIME)
+
+        for job in jobs:
+            assert Job.get_by_id(job.id).status == "SUCCESS", "Should succeed with every persistent job."
+        pids_after = set(pool.idle_pids())
+        assert pids_after <= pids_before, "Should not start new workers while the warm ones are usable."
+
+    def test_scheduled_job_output_is_truncated_at_limit(self):
+        limit = 4
+        previous_limit = app.config["DEFAULT_CMD_MAX_STDOUT_BYTES"]
+        app.config["DEFAULT_CMD_MAX_STDOUT_BYTES"] = limit
+        try:
+            job = JobHelper.prepare_job(save=True)
+            time.sleep(JOB_COMPLETION_TIME)
+        finally:
+            app.config["DEFAULT_CMD_MAX_STDOUT_BYTES"] = previous_limit
+
+        job = Job.get_by_id(job.id)
+        assert job.status == "FAILED", "Should fail a job exceeding the output limit."
+        assert "truncated" in job.message, "Should note the truncation in the job message."
+
+        response = self.app.get(self._route(job.id))
+        assert response.get_data(as_text=True) == JobHelper.default_request["text"][:limit],\
+            "Should keep the output up to the limit."
+
+    def test_scheduled_job_fails_on_resource_limit(self):
+        previous_limits = app.config["DEFAULT_CMD_LIMITS"]
+        # stdin, stdout and stderr leave no descriptor to open the input
+        app.config["DEFAULT_CMD_LIMITS"] = {"open_files": 3}
+        try:
+            job = JobHelper.prepare_job(save=True)
+            time.sleep(JOB_COMPLETION_TIME)
+        finally:
+            app.config["DEFAULT_CMD_LIMITS"] = previous_limits
+
+        job = Job.get_by_id(job.id)
+        assert job.status == "FAILED", "Should fail a job exceeding a resource limit."
+        assert "open_files=3" in job.message, "Should note the resource limits in the job message."
+
     def todo_test_scheduled_job_witout_command_errors(self):
         pass
 
@@ -257,6 +357,522 @@ class RouteResultTest(ApiTest):
         pass
 
 
+class RouteFollowTest(ApiTest):
+
+    @staticmethod
+    def _route(job_id, stream="stdout", offset=None):
+        route = "/follow/{}.{}".format(job_id, stream)
+        if offset is not None:
+            route += "?offset={}".format(offset)
+        return route
+
+    def test_following_a_new_job_returns_complete_output(self):
+        # Start following before the scheduler picked the job up
+        job = JobHelper.prepare_job(save=True)
+        response = self.app.get(self._route(job.id))
+        assert response.status_code == 200, "Should return 200 OK when following a job."
+        assert response.get_data(as_text=True) == JobHelper.default_request["text"],\
+            "Should stream the complete output once the job is finished."
+        assert Job.get_by_id(job.id).is_finished(), "Should only end the stream after the job finished."
+
+    def test_following_with_offset_skips_bytes(self):
+        job = JobHelper.prepare_job(save=True)
+        response = self.app.get(self._route(job.id, offset=5))
+        assert response.get_data(as_text=True) == JobHelper.default_request["text"][5:],\
+            "Should start streaming at the given offset."
+
+    def test_following_with_negative_offset_is_rejected(self):
+        job = JobHelper.prepare_job(save=True)
+        response = self.app.get(self._route(job.id, offset=-5))
+        assert response.status_code == 400, "Should return 400 for a negative offset."
+
+    def test_following_ends_after_max_duration(self):
+        # A job, that the scheduler does not pick up and that never finishes
+        job = JobHelper.prepare_job()
+        job.status = "IN_PROGRESS"
+        job.save(force_insert=True)
+        previous = app.config["TIME_FOLLOW_MAX"]
+        app.config["TIME_FOLLOW_MAX"] = 0.2
+        try:
+            start = time.monotonic()
+            response = self.app.get(self._route(job.id))
+            response.get_data()
+        finally:
+            app.config["TIME_FOLLOW_MAX"] = previous
+        assert response.status_code == 200, "Should return 200 OK when following a job."
+        assert time.monotonic() - start < 2, "Should end the stream of an unfinished job after the max duration."
+
+    def test_following_a_failed_job_ends(self):
+        job = JobHelper.prepare_job_with_invalid_command(save=True)
+        response = self.app.get(self._route(job.id, stream="stderr"))
+        assert response.status_code == 200, "Should return 200 OK when following a failing job."
+        assert response.get_data(as_text=True) == "", "Should end the stream empty for a failed job."
+
+    def test_following_returns_404_on_missing_job_or_stream(self):
+        job = JobHelper.prepare_job(save=False)
+        response = self.app.get(self._route(job.id))
+        assert response.status_code == 404, "Should return 404 when following a missing job."
+
+        job = JobHelper.prepare_job(save=True)
+        response = self.app.get(self._route(job.id, stream="invalid"))
+        assert response.status_code == 404, "Should return 404 when following an invalid stream."
+
+
+class CommandDefinitionTest(unittest.TestCase):
+
+    def test_malformed_definitions_are_rejected(self):
+        definitions = [
+            {"exec": ["true"]},
+            {"name": "no-exec"},
+            {"name": "bad-exec", "exec": ["true", 1]},
+            {"name": "bad-key", "exec": ["true"], "timeuot": 1.0},
+            {"name": "bad-timeout", "exec": ["true"], "timeout": -1},
+            {"name": "bad-limit", "exec": ["true"], "limits": {"memory": 1024}},
+            {"name": "bad-worker", "exec": ["true"], "persistent": {"pool_size": 1}},
+            {"name": "cpu-limited-worker", "exec": ["true"], "persistent": {"worker": ["cat"]},
+             "limits": {"cpu_seconds": 1}},
+            {"name": "duplicate-option", "exec": ["true", Option("a", to_shell="-a"), Option("a", to_shell="-b")]},
+        ]
+        for definition in definitions:
+            assert does_throw(lambda: _compile_command(definition), ValueError),\
+                "Should reject the malformed definition: {}".format(definition)
+
+    def test_arguments_are_built_in_definition_order(self):
+        command = _compile_command({
+            "name": "test",
+            "exec": ["cmd", Option("a", to_shell="-a"), Option("b", to_shell="-b", nargs=2), FilePath()],
+        })
+        args = command.build_args(["b", "x y", "z", "a"], "/some/file")
+        assert args == ["cmd", "-a", "-b", "'x y'", "z", "/some/file"], "Should build escaped args in exec order."
+
+
+class RunBoundedTest(unittest.TestCase):
+
+    def _run(self, args, timeout, limits=None):
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            start = time.monotonic()
+            try:
+                _run_bounded(args, stdout, stderr, timeout=timeout, limits=limits)
+            finally:
+                self.elapsed = time.monotonic() - start
+
+    def test_timeout_kills_background_children(self):
+        args = ["sh", "-c", "sleep 5 & sleep 5"]
+        assert does_throw(lambda: self._run(args, timeout=0.2), TimeoutExpired), "Should time out."
+        assert self.elapsed < 2, "Should not wait for children holding the output pipes."
+
+    def test_children_left_behind_do_not_block(self):
+        self._run(["sh", "-c", "sleep 5 &"], timeout=3)
+        assert self.elapsed < 2, "Should not wait for children left behind by a finished process."
+
+    def test_limits_are_applied(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            args = ["dd", "if=/dev/zero", "of={}".format(os.path.join(tmp_dir, "out")), "bs=1024", "count=64"]
+            try:
+                self._run(args, timeout=3, limits={"file_size": 1024, "nice": 1})
+                error = None
+            except ResourceLimitError as e:
+                error = e
+        assert error is not None and "file size limit" in str(error), "Should blame the file size limit."
+
+
+class WorkerTest(unittest.TestCase):
+
+    def test_request_to_a_stuck_worker_times_out(self):
+        # A worker, that never reads its stdin, with a request larger
+        # than the pipe's buffer
+        worker = Worker(["sleep", "10"])
+        try:
+            with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+                start = time.monotonic()
+                assert does_throw(lambda: worker.handle(["x" * 1024 * 1024], stdout, stderr, timeout=0.2),
+                                  TimeoutExpired), "Should time out while writing the request."
+            assert time.monotonic() - start < 2, "Should not block on writing the request."
+        finally:
+            worker.stop()
+
+
+class CallbackSinkHandler(BaseHTTPRequestHandler):
+    """
+    Records the callbacks posted to it. Answers with the status codes
+    in the server's responses list first, then with 200. Redirects
+    point to another path on the same server.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.received.append((self.path, json.loads(body) if body else None))
+        code = self.server.responses.pop(0) if self.server.responses else 200
+        self.send_response(code)
+        if 300 <= code < 400:
+            self.send_header("Location", "/redirected")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # A followed redirect would turn the post into a get
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class CallbackTest(ApiTest):
+
+    def setUp(self):
+        super().setUp()
+        time.sleep(RATE_LIMITING_WAIT_TIME)
+        self.sink = HTTPServer(("127.0.0.1", 0), CallbackSinkHandler)
+        self.sink.received = []
+        self.sink.responses = []
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        self.sink_url = "http://127.0.0.1:{}/hooks/".format(self.sink.server_address[1])
+        self.previous_allow_list = app.config["CALLBACK_URL_ALLOW_LIST"]
+        app.config["CALLBACK_URL_ALLOW_LIST"] = [self.sink_url]
+
+    def tearDown(self):
+        app.config["CALLBACK_URL_ALLOW_LIST"] = self.previous_allow_list
+        self.sink.shutdown()
+        self.sink.server_close()
+        super().tearDown()
+
+    def _run_with_callback(self, callback: str):
+        data = {"text": "Some text here.", "command": {"name": "cat", "options": []}, "callback": callback}
+        return self.post_json("/run", data)
+
+    def test_callback_is_posted_on_completion(self):
+        response = self._run_with_callback(self.sink_url + "job-done")
+        job_id = response.get_json()["job"]
+        time.sleep(JOB_COMPLETION_TIME)
+
+        assert len(self.sink.received) == 1, "Should post exactly one callback for a finished job."
+        path, payload = self.sink.received[0]
+        assert path == "/hooks/job-done", "Should post to the given callback url."
+        assert payload["id"] == job_id and payload["status"] == "SUCCESS", "Should post the job's final status."
+        assert payload["stdout"].endswith("/result/{}.stdout".format(job_id)), "Should post the result links."
+
+    def test_failed_callback_is_retried(self):
+        self.sink.responses = [500, 503]
+        self._run_with_callback(self.sink_url)
+        time.sleep(JOB_COMPLETION_TIME)
+        assert len(self.sink.received) == 3, "Should retry a callback after server errors."
+
+    def test_callback_redirect_is_not_followed(self):
+        self.sink.responses = [302]
+        self._run_with_callback(self.sink_url)
+        time.sleep(JOB_COMPLETION_TIME)
+        assert [path for path, _ in self.sink.received] == ["/hooks/"], "Should not follow a redirect."
+
+    def test_malformed_request_is_not_notified(self):
+        job = JobHelper.prepare_job()
+        for request in ["not json", "[]"]:
+            job.request = request
+            job.status = "FAILED"
+            callbacks.notify(job)
+        assert callbacks.deliveries.empty(), "Should not queue a callback for a malformed request."
+
+    def test_callback_outside_allow_list_is_rejected(self):
+        # An entry without the trailing slash must not allow siblings either
+        app.config["CALLBACK_URL_ALLOW_LIST"] = [self.sink_url.rstrip("/")]
+        base_url = self.sink_url.rstrip("/")
+        urls = [
+            "http://127.0.0.2/hooks/",
+            self.sink_url.replace("/hooks/", "/other/"),
+            "file:///etc/passwd",
+            base_url + "evil",
+            base_url + "/../admin",
+            base_url + "/%2E%2E/admin",
+        ]
+        for url in urls:
+            time.sleep(RATE_LIMITING_WAIT_TIME)
+            response = self._run_with_callback(url)
+            assert response.status_code == 400, "Should reject a callback url not allowed: {}".format(url)
+
+
+class RespStandInHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the few list and hash commands of the Redis protocol used by
+    the queue, keeping the lists and hashes in the server's memory.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self._reply(args))
+
+    @staticmethod
+    def _bulk(value: bytes) -> bytes:
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _reply(self, args) -> bytes:
+        lists = self.server.lists
+        hashes = self.server.hashes
+        with self.server.lock:
+            command = args[0].upper()
+            if command == b"LPUSH":
+                lists.setdefault(args[1], []).insert(0, args[2])
+                return b":%d\r\n" % len(lists[args[1]])
+            if command == b"RPOPLPUSH":
+                if not lists.get(args[1]):
+                    return b"$-1\r\n"
+                value = lists[args[1]].pop()
+                lists.setdefault(args[2], []).insert(0, value)
+                return b"$%d\r\n%s\r\n" % (len(value), value)
+            if command == b"LREM":
+                values = lists.get(args[1], [])
+                if args[3] in values:
+                    values.remove(args[3])
+                    return b":1\r\n"
+                return b":0\r\n"
+            if command == b"LRANGE":
+                values = lists.get(args[1], [])
+                return b"*%d\r\n" % len(values) + b"".join(self._bulk(value) for value in values)
+            if command in [b"HSET", b"HSETNX"]:
+                fields = hashes.setdefault(args[1], {})
+                if command == b"HSETNX" and args[2] in fields:
+                    return b":0\r\n"
+                fields[args[2]] = args[3]
+                return b":1\r\n"
+            if command == b"HDEL":
+                return b":%d\r\n" % (hashes.get(args[1], {}).pop(args[2], None) is not None)
+            if command == b"HGETALL":
+                fields = hashes.get(args[1], {})
+                return b"*%d\r\n" % (2 * len(fields)) \
+                    + b"".join(self._bulk(key) + self._bulk(value) for key, value in fields.items())
+            return b"-ERR unknown command\r\n"
+
+
+class QueueBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RespStandInHandler)
+        self.server.daemon_threads = True
+        self.server.lists = {}
+        self.server.hashes = {}
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = "redis://127.0.0.1:{}/0".format(self.server.server_address[1])
+        self.queue = RedisJobQueue(url=url, key="test:jobs", claim_timeout=60.0)
+
+    def tearDown(self):
+        self.queue.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def _prepare_job() -> Job:
+        # Use a status the scheduler's own queue does not pick up
+        job = JobHelper.prepare_job()
+        job.status = "FAILED"
+        job.save(force_insert=True)
+        return job
+
+    def test_jobs_are_claimed_in_order(self):
+        jobs = [self._prepare_job() for _ in range(3)]
+        for job in jobs:
+            self.queue.enqueue(job)
+
+        for job in jobs:
+            claimed = self.queue.claim()
+            assert str(claimed.id) == str(job.id), "Should claim jobs in the order they were enqueued."
+            assert claimed.status == "IN_PROGRESS", "Should mark a claimed job as in progress."
+        assert self.queue.claim() is None, "Should claim nothing from an empty queue."
+
+    def test_completed_jobs_leave_processing(self):
+        job = self._prepare_job()
+        self.queue.enqueue(job)
+        claimed = self.queue.claim()
+        assert self.server.lists[b"test:jobs:processing"] == [str(job.id).encode()],\
+            "Should keep a claimed job in the processing list."
+        self.queue.complete(claimed)
+        assert self.server.lists[b"test:jobs:processing"] == [], "Should remove a completed job from processing."
+
+    def test_deleted_jobs_are_skipped(self):
+        job = self._prepare_job()
+        self.queue.enqueue(job)
+        job.delete_instance()
+        assert self.queue.claim() is None, "Should not claim a job deleted while queued."
+        assert self.server.lists[b"test:jobs:processing"] == [], "Should not keep a deleted job in processing."
+
+    def test_stale_claims_are_requeued(self):
+        unfinished, finished = self._prepare_job(), self._prepare_job()
+        for job in [unfinished, finished]:
+            self.queue.enqueue(job)
+            self.queue.claim()
+        # The executor crashed while running the first job
+        Job.update(status="IN_PROGRESS").where(Job.id == unfinished.id).execute()
+        Job.update(status="SUCCESS").where(Job.id == finished.id).execute()
+
+        self.queue.requeue_stale()
+        assert len(self.server.lists[b"test:jobs:processing"]) == 2, "Should not requeue recent claims."
+
+        self.queue.claim_timeout = 0.0
+        self.queue.requeue_stale()
+        assert self.server.lists[b"test:jobs:processing"] == [], "Should remove stale claims from processing."
+        assert self.server.lists[b"test:jobs"] == [str(unfinished.id).encode()],\
+            "Should requeue only the unfinished job."
+        assert self.server.hashes[b"test:jobs:claims"] == {}, "Should forget the times of stale claims."
+
+    def test_unreachable_queue_keeps_no_job(self):
+        with socketserver.TCPServer(("127.0.0.1", 0), socketserver.BaseRequestHandler) as closed:
+            url = "redis://127.0.0.1:{}/0".format(closed.server_address[1])
+        previous_queue = app_module.job_queue
+        app_module.job_queue = RedisJobQueue(url=url, key="test:jobs")
+        jobs_before = Job.select().count()
+        uploads_before = set(os.listdir(uploads_dir()))
+        try:
+            time.sleep(RATE_LIMITING_WAIT_TIME)
+            response = app.test_client().post("/run", data=json.dumps(JobHelper.default_request))
+        finally:
+            app_module.job_queue = previous_queue
+        assert response.status_code == 503, "Should return 503 if the job can not be queued."
+        assert Job.select().count() == jobs_before, "Should not keep the job in the database."
+        assert set(os.listdir(uploads_dir())) == uploads_before, "Should not keep the job's upload."
+
+    def test_incomplete_backend_fails_on_creation(self):
+        class IncompleteQueue(JobQueue):
+            def enqueue(self, job: Job):
+                pass
+        assert does_throw(IncompleteQueue, TypeError), "Should not create a queue without claim and complete."
+
+    def test_postgres_claims_skip_locked_jobs(self):
+        # Only the claim's query is checked, running it needs a PostgreSQL
+        # server, which the tests do not have.
+        sql, _ = PostgresJobQueue.next_job_query().bind(PostgresqlDatabase(None)).sql()
+        assert sql.endswith("FOR UPDATE SKIP LOCKED"), "Should skip jobs locked by other executors."
+
+
+class AsgiTest(unittest.TestCase):
+
+    def request(self, method: str, path: str, body=b"", headers=(), query=b"", disconnect=False,
+                on_send=None) -> (int, bytes):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query,
+            "headers": [(b"x-forwarded-for", b"127.0.0.3")] + list(headers),
+            "client": ("127.0.0.1", 12345),
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            if disconnect:
+                return {"type": "http.disconnect"}
+            # Like a server, whose client stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+            if on_send:
+                on_send(message)
+
+        asyncio.run(application(scope, receive, send))
+        self.response_headers = dict(sent[0]["headers"])
+        status = sent[0]["status"]
+        return status, b"".join(message.get("body", b"") for message in sent[1:])
+
+    def test_run_and_fetch_result(self):
+        time.sleep(RATE_LIMITING_WAIT_TIME)
+        status, body = self.request("POST", "/run", body=json.dumps(JobHelper.default_request).encode())
+        assert status == 200, "Should return 200 OK on running with text."
+        job_id = json.loads(body)["job"]
+        assert UUID_REGEX.match(job_id), "Should return a uuid as job id."
+
+        status, body = self.request("GET", "/follow/{}.stdout".format(job_id))
+        assert status == 200, "Should return 200 OK when following a job."
+        assert body.decode() == JobHelper.default_request["text"], "Should stream the complete output."
+
+        status, body = self.request("GET", "/status/{}".format(job_id))
+        assert json.loads(body)["status"] == "SUCCESS", "Should return the job's status."
+
+        status, body = self.request("GET", "/result/{}.stdout".format(job_id))
+        assert status == 200, "Should return 200 OK on a result request."
+        assert body.decode() == JobHelper.default_request["text"], "Should return the result file."
+
+    def test_run_with_file_upload(self):
+        time.sleep(RATE_LIMITING_WAIT_TIME)
+        boundary = "test-boundary"
+        data = json.dumps({"command": {"name": "cat", "options": []}})
+        body = ("--{0}\r\nContent-Disposition: form-data; name=\"data\"\r\n\r\n{1}\r\n"
+                "--{0}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"test.txt\"\r\n"
+                "Content-Type: text/plain\r\n\r\nFile content\r\n--{0}--\r\n").format(boundary, data)
+        headers = [(b"content-type", "multipart/form-data; boundary={}".format(boundary).encode())]
+        status, body = self.request("POST", "/run", body=body.encode(), headers=headers)
+        assert status == 200, "Should return 200 OK on running with file."
+        with open(upload_path(Job.get_by_id(json.loads(body)["job"]))) as file:
+            assert file.read() == "File content", "Should have saved the uploaded file."
+
+    def test_invalid_requests_are_rejected(self):
+        time.sleep(RATE_LIMITING_WAIT_TIME)
+        uploads_before = set(os.listdir(uploads_dir()))
+        data = {"text": "", "command": {"name": "invalid", "options": []}}
+        status, _ = self.request("POST", "/run", body=json.dumps(data).encode())
+        assert status == 400, "Should return 400 for an invalid command name."
+        data = {"text": 5, "command": {"name": "date", "options": []}}
+        status, _ = self.request("POST", "/run", body=json.dumps(data).encode())
+        assert status == 400, "Should return 400 for a text that is not a string."
+        assert set(os.listdir(uploads_dir())) == uploads_before, "Should not write invalid requests to disk."
+
+        job = JobHelper.prepare_job(save=True)
+        status, _ = self.request("GET", "/follow/{}.stdout".format(job.id), query=b"offset=-5")
+        assert status == 400, "Should return 400 for a negative offset."
+
+        job = JobHelper.prepare_job(save=False)
+        for path in ["/status/{}".format(job.id), "/result/../../etc/passwd", "/unknown"]:
+            status, _ = self.request("GET", path)
+            assert status == 404, "Should return 404 for: {}".format(path)
+
+    def test_result_uses_x_sendfile_if_configured(self):
+        job = JobHelper.prepare_job(save=True)
+        with open(result_path_stdout(job), "w") as file:
+            file.write("Some output")
+        previous = app.use_x_sendfile
+        app.use_x_sendfile = True
+        try:
+            status, body = self.request("GET", "/result/{}.stdout".format(job.id))
+        finally:
+            app.use_x_sendfile = previous
+        assert status == 200 and body == b"", "Should leave the body to the web server."
+        assert self.response_headers[b"x-sendfile"] == os.path.abspath(result_path_stdout(job)).encode(),\
+            "Should point the web server to the result file."
+
+    def test_follow_state_is_dropped_on_disconnect(self):
+        # A job, that the scheduler does not pick up and that never finishes
+        job = JobHelper.prepare_job()
+        job.status = "IN_PROGRESS"
+        job.save(force_insert=True)
+        key = str(job.id)
+        followed = []
+
+        def on_send(message):
+            if message["type"] == "http.response.start":
+                followed.append(key in followers)
+
+        status, _ = self.request("GET", "/follow/{}.stdout".format(job.id), disconnect=True, on_send=on_send)
+        assert status == 200, "Should return 200 OK when following a job."
+        assert followed == [True], "Should count the follower while the stream is open."
+        assert key not in status_checks and key not in followers,\
+            "Should drop the job's status check once its last follower is gone."
+
+    def test_client_key_is_the_first_forwarded_address(self):
+        scope = {"method": "GET", "path": "/", "headers": [(b"x-forwarded-for", b"10.0.0.1, 10.0.0.2")]}
+        previous = app.config["RATE_LIMITING_USE_X_FORWARDED_FOR"]
+        app.config["RATE_LIMITING_USE_X_FORWARDED_FOR"] = True
+        try:
+            assert Request(scope, None).client_key() == "10.0.0.1", "Should use the first forwarded address."
+        finally:
+            app.config["RATE_LIMITING_USE_X_FORWARDED_FOR"] = previous
+
+
 def does_throw(my_callable: (), exception_class):
     result = False
     try:
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+from .models import Job
+
+
+config = {}
+
+log = object()
+
+# Callbacks waiting for delivery, as pairs of url and payload
+deliveries = queue.Queue()
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # A redirect could lead anywhere outside of the allow list, so it is
+    # not followed and the delivery fails with the 3xx status instead.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirectHandler)
+
+
+def init_callbacks(app_config, app_logger):
+    global config
+    global log
+    global deliveries
+
+    config = app_config
+    log = app_logger
+
+    deliveries = queue.Queue(maxsize=config.get("CALLBACK_QUEUE_SIZE"))
+    for idx in range(config.get("CALLBACK_WORKERS")):
+        threading.Thread(target=_deliver_forever, name="callback-delivery-{}".format(idx), daemon=True).start()
+
+
+def is_allowed(url: str) -> bool:
+    """
+    Whether a callback url matches one of the CALLBACK_URL_ALLOW_LIST
+    entries: the scheme, host and port have to be the same and the path
+    has to be the entry's path or below it. Paths with dot segments,
+    which a server could resolve to outside of the entry's path, are
+    never allowed.
+    """
+    if not isinstance(url, str):
+        return False
+    parts = urlsplit(url)
+    if parts.scheme not in ["http", "https"]:
+        return False
+    lowered_path = parts.path.lower()
+    if "%2e" in lowered_path or "%2f" in lowered_path \
+            or any(segment in [".", ".."] for segment in parts.path.split("/")):
+        return False
+    for allowed_url in config.get("CALLBACK_URL_ALLOW_LIST", []):
+        allowed = urlsplit(allowed_url)
+        if (parts.scheme, parts.hostname, parts.port) != (allowed.scheme, allowed.hostname, allowed.port):
+            continue
+        # Match whole segments only, "/hooks" does not allow "/hooksevil"
+        base = allowed.path.rstrip("/")
+        if parts.path == base or parts.path.startswith(base + "/"):
+            return True
+    return False
+
+
+def notify(job: Job):
+    """
+    Queue the delivery of a finished job's status to its callback url,
+    if it has one. Never blocks, a full queue drops the callback.
+    """
+    try:
+        url = json.loads(job.request).get("callback") if job.request else None
+    except (ValueError, AttributeError) as e:
+        # The job might have been failed for its malformed request
+        log.error("Not notifying job {}, its request is malformed: {}".format(job.id, e))
+        return
+    if not url or not job.is_finished():
+        return
+    try:
+        deliveries.put_nowait((url, _payload(job)))
+    except queue.Full:
+        log.error("Dropping callback for job {}, the delivery queue is full.".format(job.id))
+
+
+def _payload(job: Job) -> dict:
+    result_url = "{}/result/{}".format(config.get("PUBLIC_URL", "").rstrip("/"), job.id)
+    return {
+        "id": str(job.id),
+        "status": job.status,
+        "message": job.message,
+        "stdout": result_url + ".stdout",
+        "stderr": result_url + ".stderr",
+    }
+
+
+def _deliver_forever():
+    while True:
+        url, payload = deliveries.get()
+        try:
+            _deliver(url, payload)
+        except Exception as e:
+            log.error("Unexpected error in callback delivery: {}".format(e))
+        finally:
+            deliveries.task_done()
+
+
+def _deliver(url: str, payload: dict):
+    data = json.dumps(payload).encode("utf-8")
+    attempts = 1 + config.get("CALLBACK_RETRIES")
+    for attempt in range(1, attempts + 1):
+        request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with _opener.open(request, timeout=config.get("CALLBACK_TIMEOUT")):
+                return
+        except urllib.error.HTTPError as e:
+            # A client error will not go away by retrying
+            if e.code < 500:
+                log.error("Callback for job {} rejected with: {}".format(payload["id"], e))
+                return
+            error = e
+        except (urllib.error.URLError, OSError) as e:
+            error = e
+        log.debug("Callback attempt {} of {} for job {} failed with: {}".format(
+            attempt, attempts, payload["id"], error))
+        if attempt < attempts:
+            time.sleep(config.get("CALLBACK_RETRY_DELAY") * 2 ** (attempt - 1))
+    log.error("Giving up on callback for job {} to: {}".format(payload["id"], url))
@@ -1,25 +1,75 @@
 # -*- coding: utf-8 -*-
 
+import atexit
+import functools
+import os
+import resource
 import shlex
-from subprocess import run
+import signal
+import threading
+import time
+from subprocess import Popen, PIPE, CalledProcessError, TimeoutExpired
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
 from . import files
 from .models import Job
+from .workers import WorkerPool
 
 config = {}
 
 log = object()
 
-commands = []
+# The compiled command templates by name
+registry = {}
+
+# The pools of warm worker processes for persistent commands by name
+worker_pools = {}
+
+# How long to wait for the output of a finished or killed process to be
+# copied, before giving up on processes it left behind (in seconds)
+PUMP_JOIN_TIMEOUT = 1.0
+
+# Maps the resource limit names usable in command definitions to the
+# rlimits they set for the spawned process. The additional limit "nice"
+# is an increment to the process' niceness.
+resource_limits = {
+    "address_space": resource.RLIMIT_AS,
+    "cpu_seconds": resource.RLIMIT_CPU,
+    "file_size": resource.RLIMIT_FSIZE,
+    "open_files": resource.RLIMIT_NOFILE,
+    "processes": resource.RLIMIT_NPROC,
+}
 
 
 def init_commands(app_config, app_logger, commands_list):
     global config
     global log
-    global commands
+    global registry
 
     config = app_config
     log = app_logger
-    commands = commands_list
+
+    # Fail on startup, rather than on the first job using a bad definition
+    _check_limits(config.get("DEFAULT_CMD_LIMITS") or {})
+    compiled = {}
+    for definition in commands_list:
+        command = _compile_command(definition)
+        if command.name in compiled:
+            raise ValueError("Duplicate command name: {}".format(command.name))
+        compiled[command.name] = command
+    registry = compiled
+
+    _init_worker_pools()
+
+
+def validate_command(name: str, options: [str]):
+    """
+    Check that a job could be run with the given command name and
+    options. Raises a ValueError otherwise.
+    """
+    if not isinstance(options, list) or not all(isinstance(option, str) for option in options):
+        raise ValueError("Options must be a list of strings.")
+    _get_command(name).build_args(options)
 
 
 class Option:
@@ -31,28 +81,18 @@ class Option:
         self.args_escape = args_escape
         self.fail_if_missing = fail_if_missing
 
-    def consume(self, args: [str]) -> [str]:
-        out_args = []
+    def to_args(self, option_args: [str]) -> [str]:
+        # put the option argument itself on the result followed by
+        # the escaped option strings
+        return [self.to_shell] + [self.args_escape(option_arg) for option_arg in option_args]
 
-        if self.name in args:
-            idx = args.index(self.name)
 
-            # put the option argument itself on the result
-            out_args.append(self.to_shell)
-            try:
-                # collect option strings and put them on the result
-                for option_arg in args[(idx + 1):(idx + 1 + self.nargs)]:
-                    out_args.append(self.args_escape(option_arg))
-            except ValueError:
-                raise ValueError(
-                    "Wrong argument count for option '{}': {}".format(self.name, self.nargs))
+class OutputLimitError(Exception):
+    pass
 
-            # delete the consumed options
-            del args[idx:idx + 1 + self.nargs]
-        elif self.fail_if_missing:
-            raise ValueError("Missing option '{}'".format(self.name))
 
-        return out_args
+class ResourceLimitError(Exception):
+    pass
 
 
 class FilePath:
@@ -61,21 +101,118 @@ class FilePath:
         self.fail_if_empty = fail_if_empty
 
 
+class CommandTemplate(NamedTuple):
+    """
+    A command definition, validated and compiled once on startup.
+    Settings the definition leaves out are None and fall back to the
+    config's defaults when the command is run.
+    """
+
+    name: str
+    exec_elems: tuple
+    options: Mapping[str, Option]
+    timeout: Optional[float]
+    max_stdout_bytes: Optional[int]
+    max_stderr_bytes: Optional[int]
+    limits: Mapping[str, int]
+    persistent: Optional[Mapping]
+
+    def build_args(self, cmd_options: [str], job_file_path="") -> [str]:
+        # Collect the user's options with their arguments in a single pass
+        given = {}
+        idx = 0
+        while idx < len(cmd_options):
+            option = self.options.get(cmd_options[idx])
+            if option is None or option.name in given:
+                log.debug("Unhandled option: {}".format(cmd_options[idx]))
+                raise ValueError("Some options were not handled.")
+            option_args = cmd_options[(idx + 1):(idx + 1 + option.nargs)]
+            if len(option_args) < option.nargs:
+                raise ValueError(
+                    "Wrong argument count for option '{}': {}".format(option.name, option.nargs))
+            given[option.name] = option_args
+            idx += 1 + option.nargs
+
+        args = []
+        for exec_elem in self.exec_elems:
+            if isinstance(exec_elem, str):
+                args.append(exec_elem)
+            elif isinstance(exec_elem, Option):
+                if exec_elem.name in given:
+                    args += exec_elem.to_args(given[exec_elem.name])
+                elif exec_elem.fail_if_missing:
+                    raise ValueError("Missing option '{}'".format(exec_elem.name))
+            else:
+                args.append(job_file_path)
+        return args
+
+
+class _OutputPump(threading.Thread):
+    """
+    Copies a process' output from a pipe to a file, but at most max_bytes
+    of it. On overflow the output is truncated and on_overflow is called.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, name: str, source, target, max_bytes, on_overflow):
+        super().__init__(name="output-pump-{}".format(name), daemon=True)
+        self.stream_name = name
+        self.source = source
+        self.target = target
+        self.max_bytes = max_bytes
+        self.on_overflow = on_overflow
+        self.overflowed = False
+
+    def run(self):
+        written = 0
+        try:
+            for chunk in iter(lambda: self.source.read(self.chunk_size), b""):
+                if self.max_bytes is not None and written + len(chunk) > self.max_bytes:
+                    self.target.write(chunk[:self.max_bytes - written])
+                    self.overflowed = True
+                    self.on_overflow()
+                    break
+                self.target.write(chunk)
+                written += len(chunk)
+        except (OSError, ValueError):
+            # The pipe or the target was closed after giving up on the pump
+            pass
+
+
 def execute_command(name: str, options: [str], job: Job):
-    stdout = open(files.result_path_stdout(job), "wb")
-    stderr = open(files.result_path_stderr(job), "wb")
+    # Unbuffered, so that the output can be followed while it is written
+    stdout = open(files.result_path_stdout(job), "wb", buffering=0)
+    stderr = open(files.result_path_stderr(job), "wb", buffering=0)
+    limits = {}
     try:
+        command = _get_command(name)
         job_input_file = files.upload_path(job)
-        args = _prepare_command_args(name, options, job_input_file)
+        args = command.build_args(options, job_input_file)
+
+        limits = _command_limits(command)
 
         job.update_status("IN_PROGRESS")
         log.debug("Executing: '{}'".format(" ".join(args)))
-        run(args,
-            stdout=stdout,
-            stderr=stderr,
-            check=True,
-            timeout=_command_timeout(name))
+        output_args = dict(stdout=stdout,
+                           stderr=stderr,
+                           timeout=_command_timeout(command),
+                           max_stdout_bytes=_command_output_limit(command, "stdout"),
+                           max_stderr_bytes=_command_output_limit(command, "stderr"))
+        if command.persistent:
+            # The limits were applied to the worker process on its start
+            _run_persistent(worker_pools[command.name], args, **output_args)
+        else:
+            _run_bounded(args, limits=limits, **output_args)
         job.update_status("SUCCESS")
+    # A process failing because of a limit might not be distinguishable
+    # from other failures, so the limits are included in the message.
+    except CalledProcessError as e:
+        msg = "Job failed with: {}".format(repr(e))
+        if limits:
+            msg += " (Process ran with resource limits: {})".format(_format_limits(limits))
+        log.debug(msg)
+        job.fail_with_message(msg)
     # This catches errors from our program as well as from the called
     # process, since the latter are wrapped as subprocess.SubprocessError
     except Exception as e:
@@ -87,37 +224,289 @@ def execute_command(name: str, options: [str], job: Job):
         stderr.close()
 
 
-def _prepare_command_args(cmd_name: str, cmd_options: [str], job_file_path="") -> [str]:
-    args = []
-    command_def = _get_command_def(cmd_name)
+def _run_bounded(args: [str], stdout, stderr, timeout: float, max_stdout_bytes=None, max_stderr_bytes=None,
+                 limits=None):
+    """
+    Run a process like subprocess.run(check=True) would, but pump its
+    output into the given files through bounded buffers. A process
+    exceeding an output limit is killed and OutputLimitError is raised.
+    Resource limits are applied to the process before it is executed.
+
+    The process runs in a new session, so that on a timeout or overflow
+    the processes it started are killed with it. Those could otherwise
+    hold the output pipes open long after the process itself is gone.
+    """
+    with _spawn(args, limits, stdout=PIPE, stderr=PIPE, bufsize=0, start_new_session=True) as process:
+        pumps = [
+            _OutputPump("stdout", process.stdout, stdout, max_stdout_bytes, lambda: _kill_process_group(process)),
+            _OutputPump("stderr", process.stderr, stderr, max_stderr_bytes, lambda: _kill_process_group(process)),
+        ]
+        for pump in pumps:
+            pump.start()
+        try:
+            process.wait(timeout=timeout)
+        except TimeoutExpired:
+            _kill_process_group(process)
+            raise
+        finally:
+            _join_pumps(process, pumps)
+
+    for pump in pumps:
+        if pump.overflowed:
+            _raise_output_limit_error(pump.stream_name, pump.max_bytes)
+    if limits and process.returncode < 0:
+        _raise_resource_limit_error(-process.returncode, limits)
+    if process.returncode:
+        raise CalledProcessError(process.returncode, args)
+
+
+def _kill_process_group(process: Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Everything in the group has exited already
+        pass
+
+
+def _join_pumps(process: Popen, pumps: [_OutputPump]):
+    def join_all():
+        deadline = time.monotonic() + PUMP_JOIN_TIMEOUT
+        for pump in pumps:
+            pump.join(max(0.0, deadline - time.monotonic()))
+
+    join_all()
+    if any(pump.is_alive() for pump in pumps):
+        # Processes left in the group still hold the pipes open
+        _kill_process_group(process)
+        join_all()
+    process.stdout.close()
+    process.stderr.close()
+
+
+def _run_persistent(pool: WorkerPool, args: [str], stdout, stderr, timeout: float, max_stdout_bytes=None,
+                    max_stderr_bytes=None):
+    """
+    Run a job on one of the pool's warm workers. Failures are reported
+    like _run_bounded() does for a newly spawned process.
+    """
+    returncode, overflowed = pool.run(args, stdout, stderr, timeout, max_stdout_bytes, max_stderr_bytes)
+    if "stdout" in overflowed:
+        _raise_output_limit_error("stdout", max_stdout_bytes)
+    if "stderr" in overflowed:
+        _raise_output_limit_error("stderr", max_stderr_bytes)
+    if returncode:
+        raise CalledProcessError(returncode, args)
+
+
+def _raise_output_limit_error(stream: str, max_bytes: int):
+    raise OutputLimitError("Output on {} exceeded the limit of {} bytes and was truncated.".format(stream, max_bytes))
+
 
-    for exec_elem in command_def["exec"]:
-        if isinstance(exec_elem, str):
-            args.append(exec_elem)
-        elif isinstance(exec_elem, Option):
-            args += exec_elem.consume(cmd_options)
-        elif isinstance(exec_elem, FilePath):
-            args.append(job_file_path)
+def _raise_resource_limit_error(signum: int, limits: dict):
+    # Blames the limit most likely to have caused the signal, if any
+    if signum == signal.SIGXCPU and "cpu_seconds" in limits:
+        raise ResourceLimitError("Process exceeded its CPU time limit of {} seconds.".format(limits["cpu_seconds"]))
+    if signum == signal.SIGXFSZ and "file_size" in limits:
+        raise ResourceLimitError("Process exceeded its file size limit of {} bytes.".format(limits["file_size"]))
+    if signum == signal.SIGKILL:
+        # The kernel kills on reaching the hard CPU limit, e.g. if SIGXCPU
+        # was ignored, or if the system runs out of memory.
+        if "cpu_seconds" in limits:
+            raise ResourceLimitError("Process was killed, likely for exceeding its CPU time limit of {} seconds."
+                                     .format(limits["cpu_seconds"]))
+        if "address_space" in limits:
+            raise ResourceLimitError("Process was killed, likely for exceeding its memory limit of {} bytes."
+                                     .format(limits["address_space"]))
 
-    # There should be no user defined options left at this point
-    if len(cmd_options) > 0:
-        log.debug("Unhandled options:", cmd_options)
-        raise ValueError("Some options were not handled.")
 
-    return args
+def _init_worker_pools():
+    global worker_pools
 
+    _close_worker_pools()
+    for command in registry.values():
+        if not command.persistent:
+            continue
+        limits = _command_limits(command)
+        pool = WorkerPool(list(command.persistent["worker"]),
+                          size=command.persistent.get("pool_size", 1),
+                          max_jobs=command.persistent.get("max_jobs", 100),
+                          spawn=functools.partial(_spawn, limits=limits))
+        log.debug("Starting {} worker(s) for command: {}".format(pool.size, command.name))
+        pool.warm()
+        worker_pools[command.name] = pool
+    atexit.register(_close_worker_pools)
 
-def _get_command_def(name: str):
-    for command in commands:
-        if command["name"] == name:
-            return command
-    raise ValueError("Not a command name: {}".format(name))
 
+def _close_worker_pools():
+    global worker_pools
 
-def _command_timeout(cmd_name: str) -> float:
-    cmd_def = _get_command_def(name=cmd_name)
-    if "timeout" in cmd_def:
-        timeout = cmd_def.get("timeout")
+    for pool in worker_pools.values():
+        pool.close()
+    worker_pools = {}
+
+
+# Runs the command given as its arguments, once a line can be read from
+# stdin. Until then, the process is in place to have its limits set.
+_limits_gate = ["/bin/sh", "-c", 'read -r _ && exec "$@"', "sh"]
+
+
+def _spawn(args: [str], limits=None, **popen_args) -> Popen:
+    """
+    Start a process like Popen(args, **popen_args) would, with the resource
+    limits applied before args are executed.
+
+    Running Python code between fork and exec, as preexec_fn does, is not
+    safe in a process with threads. Instead, a shell is started first, the
+    limits are set on it from the outside with prlimit(), and only then it
+    is allowed to exec into the actual command, which inherits them.
+    """
+    if not limits:
+        return Popen(args, **popen_args)
+
+    keep_stdin = popen_args.pop("stdin", None) == PIPE
+    process = Popen(_limits_gate + list(args), stdin=PIPE, **popen_args)
+    try:
+        _apply_limits(process.pid, limits)
+        process.stdin.write(b"\n")
+        process.stdin.flush()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    if not keep_stdin:
+        # The command sees the end of its input right away
+        process.stdin.close()
+        process.stdin = None
+    return process
+
+
+def _apply_limits(pid: int, limits: dict):
+    for name, value in limits.items():
+        if name == "nice":
+            niceness = os.getpriority(os.PRIO_PROCESS, pid)
+            os.setpriority(os.PRIO_PROCESS, pid, niceness + value)
+        elif name == "cpu_seconds":
+            # Keep the hard limit above the soft limit, so that the process
+            # gets SIGXCPU, which is reported, instead of a plain SIGKILL.
+            resource.prlimit(pid, resource.RLIMIT_CPU, (value, value + 1))
+        else:
+            resource.prlimit(pid, resource_limits[name], (value, value))
+
+
+def _get_command(name: str) -> CommandTemplate:
+    try:
+        return registry[name]
+    except (KeyError, TypeError):
+        raise ValueError("Not a command name: {}".format(name))
+
+
+def _command_timeout(command: CommandTemplate) -> float:
+    if command.timeout is not None:
+        timeout = command.timeout
     else:
         timeout = config.get("DEFAULT_CMD_TIMEOUT", 1.0)
     return float(timeout)
+
+
+def _command_output_limit(command: CommandTemplate, stream: str):
+    limit = getattr(command, "max_{}_bytes".format(stream))
+    if limit is None:
+        limit = config.get("DEFAULT_CMD_MAX_{}_BYTES".format(stream.upper()))
+    return None if limit is None else int(limit)
+
+
+def _command_limits(command: CommandTemplate) -> dict:
+    limits = dict(config.get("DEFAULT_CMD_LIMITS") or {})
+    if command.persistent:
+        # A worker's CPU time adds up across its jobs, see _compile_command()
+        limits.pop("cpu_seconds", None)
+    limits.update(command.limits)
+    return limits
+
+
+_definition_keys = ["name", "exec", "timeout", "max_stdout_bytes", "max_stderr_bytes", "limits", "persistent"]
+
+
+def _compile_command(definition: dict) -> CommandTemplate:
+    """
+    Validate a command definition from the commands list and compile
+    it into a CommandTemplate.
+
+    :param definition: A command definition as documented in the README.
+    :return: The immutable template for the command.
+    """
+    name = definition.get("name") if isinstance(definition, dict) else None
+    if not isinstance(name, str) or not name:
+        raise ValueError("Invalid command definition without a name: {}".format(definition))
+
+    def invalid(reason: str):
+        return ValueError("Invalid definition of command '{}': {}".format(name, reason))
+
+    for key in definition:
+        if key not in _definition_keys:
+            raise invalid("Unknown key '{}'".format(key))
+
+    exec_elems = definition.get("exec")
+    if not isinstance(exec_elems, (list, tuple)) or not exec_elems:
+        raise invalid("'exec' must be a non-empty list.")
+    options = {}
+    for exec_elem in exec_elems:
+        if isinstance(exec_elem, Option):
+            if exec_elem.name in options:
+                raise invalid("Duplicate option '{}'".format(exec_elem.name))
+            options[exec_elem.name] = exec_elem
+        elif not isinstance(exec_elem, (str, FilePath)):
+            raise invalid("Not a string, Option or FilePath in 'exec': {!r}".format(exec_elem))
+
+    timeout = definition.get("timeout")
+    if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+        raise invalid("'timeout' must be a positive number.")
+
+    for key in ["max_stdout_bytes", "max_stderr_bytes"]:
+        limit = definition.get(key)
+        if limit is not None and (not isinstance(limit, int) or limit < 0):
+            raise invalid("'{}' must be a non-negative integer.".format(key))
+
+    limits = definition.get("limits", {})
+    try:
+        _check_limits(limits)
+    except ValueError as e:
+        raise invalid(str(e))
+
+    persistent = definition.get("persistent")
+    if persistent is not None:
+        worker = persistent.get("worker") if isinstance(persistent, dict) else None
+        if not isinstance(worker, (list, tuple)) or not worker \
+                or not all(isinstance(arg, str) for arg in worker):
+            raise invalid("'persistent' needs a 'worker' command as a list of strings.")
+        for key in ["pool_size", "max_jobs"]:
+            if not isinstance(persistent.get(key, 1), int) or persistent.get(key, 1) < 1:
+                raise invalid("'{}' must be a positive integer.".format(key))
+        # The CPU time of a worker adds up across all the jobs it handles,
+        # so a limit would fail whichever job happens to cross it.
+        if "cpu_seconds" in limits:
+            raise invalid("'cpu_seconds' can not be limited for a persistent command, use a 'timeout'.")
+        persistent = MappingProxyType(dict(persistent, worker=tuple(worker)))
+
+    return CommandTemplate(name=name,
+                           exec_elems=tuple(exec_elems),
+                           options=MappingProxyType(options),
+                           timeout=timeout,
+                           max_stdout_bytes=definition.get("max_stdout_bytes"),
+                           max_stderr_bytes=definition.get("max_stderr_bytes"),
+                           limits=MappingProxyType(dict(limits)),
+                           persistent=persistent)
+
+
+def _check_limits(limits: dict):
+    if not isinstance(limits, dict):
+        raise ValueError("Resource limits must be a dictionary: {}".format(limits))
+    for name, value in limits.items():
+        if name not in resource_limits and name != "nice":
+            raise ValueError("Not a resource limit: {}".format(name))
+        if not isinstance(value, int):
+            raise ValueError("Resource limit '{}' must be an integer: {}".format(name, value))
+
+
+def _format_limits(limits: dict) -> str:
+    return ", ".join("{}={}".format(name, value) for name, value in sorted(limits.items()))
@@ -3,6 +3,7 @@ import atexit
 import os
 import shutil
 import tempfile
+import time
 
 from .models import Job
 
@@ -113,3 +114,65 @@ def _init_directories():
 def _delete_test_directory():
     if os.path.isdir(test_dir):
         shutil.rmtree(test_dir)
+
+
+class FileFollower:
+    """
+    Reads the bytes appended to a file while it is being written, starting
+    at the given offset. The file need not exist yet when following starts.
+    """
+
+    def __init__(self, path: str, offset=0, chunk_size=64 * 1024):
+        self.path = path
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self._file = None
+
+    def read(self) -> bytes:
+        """
+        :return: The next chunk of new data or b"" if there is none yet.
+        """
+        if self._file is None:
+            if not os.path.isfile(self.path):
+                return b""
+            self._file = open(self.path, "rb")
+            self._file.seek(self.offset)
+        return self._file.read(self.chunk_size)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+def follow_file(path: str, is_finished, offset=0, interval=0.1, chunk_size=64 * 1024, max_duration=None):
+    """
+    Generator yielding the bytes appended to a file while it is being
+    written. Reading continues at the last offset, so nothing is read
+    twice.
+
+    :param path: The file to follow.
+    :param is_finished: A callable, that returns True once no more data
+                        will be written to the file.
+    :param offset: The byte offset to start reading at.
+    :param interval: How long to wait for new data in seconds.
+    :param chunk_size: The maximum size of a single yielded chunk.
+    :param max_duration: Seconds after which to stop following, even if
+                         the writer is not finished, or None to not stop.
+    :return: A generator of byte strings.
+    """
+    follower = FileFollower(path, offset=offset, chunk_size=chunk_size)
+    deadline = None if max_duration is None else time.monotonic() + max_duration
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            # Ask before reading: if the writer was finished before the
+            # read, an empty read means everything has been consumed.
+            finished = is_finished()
+            chunk = follower.read()
+            if chunk:
+                yield chunk
+            elif finished:
+                return
+            else:
+                time.sleep(interval)
+    finally:
+        follower.close()
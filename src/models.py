@@ -1,34 +1,44 @@
 
 import datetime
 
-from peewee import Model, UUIDField, CharField, DateTimeField
+from peewee import Database, DatabaseProxy, Model, UUIDField, CharField, DateTimeField, TextField
+from playhouse.db_url import connect
 from playhouse.sqlite_ext import SqliteExtDatabase
 from uuid import uuid4
 
 
 log = object
 
-db = SqliteExtDatabase(None, pragmas={
+# Either the sqlite database file or the database at DB_URL, set on init_db()
+db = DatabaseProxy()
+
+sqlite_pragmas = {
     'journal_mode': 'wal',
     'cache_size': -1 * 64000,  # 64MB
     'foreign_keys': 1,
     'ignore_check_constraints': 0,
     'synchronous': 0
-})
+}
 
 
 def _create_uuid():
     return str(uuid4())
 
 
-def init_db(db_path: str, logger: object) -> SqliteExtDatabase:
+def init_db(db_path: str, logger: object, db_url=None) -> Database:
     global log
 
     log = logger
-    log.debug("Initializing database at: {}".format(db_path))
-    db.init(db_path)
+    if db_url:
+        # Only the scheme is logged, the url may contain a password
+        log.debug("Initializing database at: {}://...".format(db_url.split("://")[0]))
+        database = connect(db_url)
+    else:
+        log.debug("Initializing database at: {}".format(db_path))
+        database = SqliteExtDatabase(db_path, pragmas=sqlite_pragmas)
+    db.initialize(database)
     db.create_tables([Job], safe=True)
-    return db
+    return database
 
 
 class BaseModel(Model):
@@ -46,12 +56,22 @@ class Job(BaseModel):
         "FAILED",
     ]
 
+    # Statuses after which a job's results do not change anymore
+    final_statuses = [
+        "SUCCESS",
+        "FAILED",
+    ]
+
     id = UUIDField(primary_key=True, default=_create_uuid)
     status = CharField(null=False)
-    request = CharField(null=True)
-    message = CharField(null=True)
+    # Text, since other databases than sqlite enforce a CharField's length
+    request = TextField(null=True)
+    message = TextField(null=True)
     created = DateTimeField(default=datetime.datetime.now)
 
+    def is_finished(self) -> bool:
+        return self.status in self.final_statuses
+
     def update_status(self, status: str):
         if status in self.statuses:
             self.status = status
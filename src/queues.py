@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit, unquote
+
+from peewee import DoesNotExist, PostgresqlDatabase
+
+from .models import db, Job
+
+
+config = {}
+
+log = object()
+
+# The queue used by the app, set on init_queue()
+queue = None
+
+
+class QueueError(Exception):
+    pass
+
+
+class JobQueue(ABC):
+    """
+    The interface between the nodes accepting jobs and the nodes executing
+    them. Jobs are always saved to the database first, a queue only hands
+    out which job should run next.
+    """
+
+    @abstractmethod
+    def enqueue(self, job: Job):
+        pass
+
+    @abstractmethod
+    def claim(self) -> Job:
+        """
+        Take the next job from the queue and mark it as in progress, so that
+        no other executor runs it.
+
+        :return: The claimed job or None if the queue is empty.
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, job: Job):
+        pass
+
+    def requeue_stale(self):
+        """
+        Put jobs back into the queue, that were claimed by an executor
+        which has likely crashed. Called regularly on every node.
+        """
+        pass
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    Uses the job table itself as the queue: every job with status NEW is
+    waiting to be run. Only usable by executors sharing the database file.
+    """
+
+    def enqueue(self, job: Job):
+        # Saving the job with status NEW already enqueued it
+        pass
+
+    def claim(self) -> Job:
+        with db.atomic():
+            job = Job.select().where(Job.status == "NEW").order_by(Job.created.asc()).first()
+            if job is None:
+                return None
+            # Only claim the job, if nobody else has in the meantime
+            claimed = Job.update(status="IN_PROGRESS") \
+                .where((Job.id == job.id) & (Job.status == "NEW")) \
+                .execute()
+        if not claimed:
+            return None
+        job.status = "IN_PROGRESS"
+        return job
+
+    def complete(self, job: Job):
+        # The job's final status is all there is to save
+        pass
+
+
+class PostgresJobQueue(JobQueue):
+    """
+    Like the SqliteJobQueue, uses the job table as the queue, but in a
+    PostgreSQL database at DB_URL, that executors on several hosts can
+    share. Rows locked by a claim in progress are skipped by the others.
+    """
+
+    def enqueue(self, job: Job):
+        # Saving the job with status NEW already enqueued it
+        pass
+
+    def claim(self) -> Job:
+        with db.atomic():
+            job = self.next_job_query().first()
+            if job is None:
+                return None
+            Job.update(status="IN_PROGRESS").where(Job.id == job.id).execute()
+        job.status = "IN_PROGRESS"
+        return job
+
+    def complete(self, job: Job):
+        # The job's final status is all there is to save
+        pass
+
+    @staticmethod
+    def next_job_query():
+        return Job.select() \
+            .where(Job.status == "NEW") \
+            .order_by(Job.created.asc()) \
+            .for_update("FOR UPDATE SKIP LOCKED")
+
+
+class RedisJobQueue(JobQueue):
+    """
+    A queue of job ids in a server speaking the Redis protocol, so that
+    executors on several hosts can share it. Claimed ids are moved to a
+    processing list atomically and removed from it on completion. The job
+    records themselves stay in the database, which has to be shared by
+    all hosts as well, see DB_URL.
+
+    The time of each claim is kept in a hash, so that ids stuck in the
+    processing list after an executor crashed can be requeued once they
+    are older than claim_timeout seconds.
+    """
+
+    def __init__(self, url: str, key: str, claim_timeout=600.0):
+        self.client = RespClient.from_url(url)
+        self.key = key
+        self.processing_key = key + ":processing"
+        self.claims_key = key + ":claims"
+        self.claim_timeout = claim_timeout
+
+    def enqueue(self, job: Job):
+        try:
+            self.client.execute("LPUSH", self.key, str(job.id))
+        except OSError as e:
+            raise QueueError("Could not enqueue job {}: {}".format(job.id, e))
+
+    def claim(self) -> Job:
+        job_id = self.client.execute("RPOPLPUSH", self.key, self.processing_key)
+        if job_id is None:
+            return None
+        self.client.execute("HSET", self.claims_key, job_id, time.time())
+        try:
+            job = Job.get_by_id(job_id.decode("utf-8"))
+        except DoesNotExist:
+            # The job was deleted while waiting in the queue
+            self._remove_claim(job_id)
+            return None
+        job.update_status("IN_PROGRESS")
+        return job
+
+    def complete(self, job: Job):
+        self._remove_claim(str(job.id))
+
+    def requeue_stale(self):
+        now = time.time()
+        processing = self.client.execute("LRANGE", self.processing_key, 0, -1)
+        claims = self.client.execute("HGETALL", self.claims_key)
+        claims = dict(zip(claims[::2], claims[1::2]))
+
+        for job_id in processing:
+            if job_id not in claims:
+                # Either claimed right now or the executor crashed before
+                # noting the time. Start the clock for the latter case.
+                self.client.execute("HSETNX", self.claims_key, job_id, now)
+            elif now - float(claims[job_id]) >= self.claim_timeout:
+                self._requeue(job_id)
+        # Claims of ids completed while they were being noted above
+        for job_id, claimed in claims.items():
+            if job_id not in processing and now - float(claimed) >= self.claim_timeout:
+                self.client.execute("HDEL", self.claims_key, job_id)
+
+    def _requeue(self, job_id: bytes):
+        # Only the node removing the id from processing requeues it
+        if not self.client.execute("LREM", self.processing_key, 1, job_id):
+            return
+        self.client.execute("HDEL", self.claims_key, job_id)
+        job = Job.get_or_none(Job.id == job_id.decode("utf-8"))
+        if job is None or job.is_finished():
+            return
+        log.warning("Requeuing job {}, its claim timed out.".format(job.id))
+        job.update_status("NEW")
+        self.client.execute("LPUSH", self.key, job_id)
+
+    def _remove_claim(self, job_id):
+        self.client.execute("LREM", self.processing_key, 1, job_id)
+        self.client.execute("HDEL", self.claims_key, job_id)
+
+
+class RespClient:
+    """
+    A minimal client for the Redis serialization protocol (RESP),
+    sufficient for the commands used by the RedisJobQueue.
+    """
+
+    def __init__(self, host: str, port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url: str) -> "RespClient":
+        # Accepts urls like: redis://:password@host:port/db
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError("Not a redis url: {}".format(url))
+        db = int(parts.path.lstrip("/") or 0)
+        password = unquote(parts.password) if parts.password else None
+        return cls(parts.hostname or "localhost", port=parts.port or 6379, db=db, password=password)
+
+    def execute(self, *args):
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._execute(args)
+            except OSError:
+                # Reconnect on the next command
+                self._close()
+                raise
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._execute(("AUTH", self.password))
+        if self.db:
+            self._execute(("SELECT", self.db))
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+        if self._sock:
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+    def _execute(self, args):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by server.")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise QueueError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._file.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise QueueError("Unexpected reply from server: {!r}".format(line))
+
+
+def init_queue(app_config, app_logger) -> JobQueue:
+    global config
+    global log
+    global queue
+
+    config = app_config
+    log = app_logger
+
+    backend = config.get("QUEUE_BACKEND", "sqlite")
+    if backend == "sqlite":
+        queue = SqliteJobQueue()
+    elif backend == "postgres":
+        if not isinstance(db.obj, PostgresqlDatabase):
+            raise ValueError("The postgres queue backend needs a PostgreSQL database as DB_URL.")
+        queue = PostgresJobQueue()
+    elif backend == "redis":
+        if not config.get("DB_URL"):
+            log.warning("The redis queue backend without a DB_URL only works on a single host.")
+        queue = RedisJobQueue(url=config.get("QUEUE_REDIS_URL"),
+                              key=config.get("QUEUE_REDIS_KEY"),
+                              claim_timeout=config.get("QUEUE_CLAIM_TIMEOUT"))
+    else:
+        raise ValueError("Not a queue backend: {}".format(backend))
+    log.debug("Using queue backend: {}".format(backend))
+    return queue
@@ -5,6 +5,7 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from peewee import DoesNotExist
 
 
+from . import callbacks, queues
 from .models import Job
 from .commands import execute_command
 
@@ -20,14 +21,14 @@ dir_downloads = "/invalid/path"
 def task_run_new_job():
     job = None
     try:
-        job = Job.get(Job.status == "NEW")
+        job = queues.queue.claim()
+        if job is None:
+            # No jobs to execute
+            return
         request = json.loads(job.request)
         execute_command(name=request["command"]["name"],
                         options=request["command"]["options"],
                         job=job)
-    except DoesNotExist:
-        # No jobs to execute
-        pass
     except KeyError as e:
         log.error("Failing job with with key error: {}".format(e))
         if job:
@@ -39,6 +40,24 @@ def task_run_new_job():
         log.error(msg)
         if job:
             job.fail_with_message(msg)
+    finally:
+        if job:
+            _complete_job(job)
+            callbacks.notify(job)
+
+
+def _complete_job(job: Job):
+    try:
+        queues.queue.complete(job)
+    except Exception as e:
+        log.error("Error when completing job {} in the queue: {}".format(job.id, e))
+
+
+def task_requeue_stale_jobs():
+    try:
+        queues.queue.requeue_stale()
+    except Exception as e:
+        log.error("Error when requeuing stale jobs: {}".format(e))
 
 
 def task_cleanup_old_job():
@@ -62,6 +81,7 @@ def task_cleanup_old_job():
 _jobs_to_config_values = [
     (task_run_new_job, "INTERVAL_JOB_START"),
     (task_cleanup_old_job, "INTERVAL_CLEANUP_START"),
+    (task_requeue_stale_jobs, "INTERVAL_CLEANUP_START"),
 ]
 
 
@@ -74,6 +94,9 @@ def init_app_scheduler(app_config, app_logger) -> BackgroundScheduler:
     scheduler = BackgroundScheduler()
 
     for func, config_key in _jobs_to_config_values:
+        if func is task_run_new_job and not config.get("EXECUTE_JOBS", True):
+            log.debug("Not executing jobs on this node.")
+            continue
         seconds = config.get(config_key)
         log.debug("Scheduling func {} with interval: {}s.".format(func.__name__, seconds))
         scheduler.add_job(func, trigger='interval', coalesce=True, seconds=seconds)
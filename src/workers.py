@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import selectors
+import threading
+import time
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Worker:
+    """
+    A long-lived process handling one job after another.
+
+    A request is a single line of JSON on the worker's stdin: the list of
+    arguments for the job. The worker answers on its stdout with a header
+    line of three space separated numbers, the exit code and the length of
+    the job's stdout and stderr in bytes, followed by exactly that many
+    bytes of stdout and then of stderr output.
+    """
+
+    chunk_size = 64 * 1024
+
+    max_header_length = 1024
+
+    def __init__(self, args: [str], spawn=Popen):
+        self.args = args
+        self.jobs_done = 0
+        self.process = spawn(args, stdin=PIPE, stdout=PIPE, stderr=DEVNULL, bufsize=0)
+        # Requests are written without blocking, so that a worker not
+        # reading its stdin can not stall past the job's timeout.
+        os.set_blocking(self.process.stdin.fileno(), False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.process.stdout, selectors.EVENT_READ)
+        self._write_selector = selectors.DefaultSelector()
+        self._write_selector.register(self.process.stdin, selectors.EVENT_WRITE)
+        self._buffer = b""
+        self._timeout = None
+        self._deadline = None
+
+    def handle(self, job_args: [str], stdout, stderr, timeout: float, max_stdout_bytes=None, max_stderr_bytes=None):
+        """
+        Send a job to the worker and copy its output to the given files.
+
+        :return: The job's exit code and a list of the names of streams,
+                 that were truncated because they exceeded their limit.
+        """
+        self._timeout = timeout
+        self._deadline = time.monotonic() + timeout
+
+        self._write(json.dumps(job_args).encode("utf-8") + b"\n")
+
+        header = self._read_line()
+        try:
+            returncode, stdout_len, stderr_len = (int(field) for field in header.split())
+        except ValueError:
+            raise WorkerError("Invalid response header from worker: {!r}".format(header))
+
+        overflowed = []
+        if self._copy(stdout_len, stdout, max_stdout_bytes):
+            overflowed.append("stdout")
+        if self._copy(stderr_len, stderr, max_stderr_bytes):
+            overflowed.append("stderr")
+
+        self.jobs_done += 1
+        return returncode, overflowed
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def stop(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+        self._selector.close()
+        self._write_selector.close()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0 or not self._write_selector.select(remaining):
+                raise TimeoutExpired(self.args, self._timeout)
+            try:
+                view = view[os.write(self.process.stdin.fileno(), view):]
+            except BlockingIOError:
+                pass
+
+    def _fill(self):
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0 or not self._selector.select(remaining):
+            raise TimeoutExpired(self.args, self._timeout)
+        data = os.read(self.process.stdout.fileno(), self.chunk_size)
+        if not data:
+            raise WorkerError("Worker closed its output unexpectedly.")
+        self._buffer += data
+
+    def _read(self, size: int) -> bytes:
+        if not self._buffer:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_line(self) -> bytes:
+        while b"\n" not in self._buffer:
+            if len(self._buffer) > self.max_header_length:
+                raise WorkerError("Response header from worker is too long.")
+            self._fill()
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line
+
+    def _copy(self, size: int, target, max_bytes) -> bool:
+        # Output beyond max_bytes is read and discarded to stay in sync
+        # with the worker. Returns whether anything was discarded.
+        written = 0
+        overflowed = False
+        while size > 0:
+            chunk = self._read(min(size, self.chunk_size))
+            size -= len(chunk)
+            if max_bytes is not None and written + len(chunk) > max_bytes:
+                chunk = chunk[:max_bytes - written]
+                overflowed = True
+            target.write(chunk)
+            written += len(chunk)
+        return overflowed
+
+
+class WorkerPool:
+    """
+    Keeps up to size workers for one command. Workers are replaced after
+    max_jobs jobs and whenever a job did not complete regularly. Workers
+    are started by calling spawn like Popen.
+    """
+
+    def __init__(self, args: [str], size=1, max_jobs=100, spawn=Popen):
+        self.args = args
+        self.size = size
+        self.max_jobs = max_jobs
+        self.spawn = spawn
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def warm(self):
+        # Start all workers upfront, so that no job waits for a start up
+        with self._lock:
+            while len(self._idle) < self.size:
+                self._idle.append(self._start_worker())
+
+    def run(self, job_args: [str], stdout, stderr, timeout: float, max_stdout_bytes=None, max_stderr_bytes=None):
+        with self._slots:
+            worker = self._acquire()
+            try:
+                result = worker.handle(job_args, stdout, stderr, timeout, max_stdout_bytes, max_stderr_bytes)
+            except BaseException:
+                worker.stop()
+                raise
+            self._release(worker)
+            return result
+
+    def idle_pids(self) -> [int]:
+        with self._lock:
+            return [worker.process.pid for worker in self._idle]
+
+    def close(self):
+        with self._lock:
+            for worker in self._idle:
+                worker.stop()
+            self._idle = []
+
+    def _start_worker(self) -> Worker:
+        return Worker(self.args, spawn=self.spawn)
+
+    def _acquire(self) -> Worker:
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                worker.stop()
+        return self._start_worker()
+
+    def _release(self, worker: Worker):
+        if worker.jobs_done >= self.max_jobs or not worker.is_alive():
+            worker.stop()
+        else:
+            with self._lock:
+                self._idle.append(worker)
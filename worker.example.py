@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# An example worker for a persistent command. It behaves like "cat",
+# optionally numbering lines with "-n", but stays alive between jobs.
+#
+# Each job arrives as a single line of JSON on stdin: the list of
+# arguments built from the command's "exec" definition. The answer on
+# stdout is a header line "<exit code> <stdout length> <stderr length>"
+# followed by the stdout and then the stderr bytes of the job.
+
+import json
+import sys
+
+
+def handle(args: [str]) -> (int, bytes, bytes):
+    with open(args[-1], "rb") as file:
+        content = file.read()
+    if "-n" in args:
+        lines = content.splitlines(keepends=True)
+        content = b"".join(b"%6d\t%s" % (i, line) for i, line in enumerate(lines, start=1))
+    return 0, content, b""
+
+
+def main():
+    for line in sys.stdin.buffer:
+        try:
+            returncode, stdout, stderr = handle(json.loads(line))
+        except Exception as e:
+            returncode, stdout, stderr = 1, b"", str(e).encode("utf-8")
+        sys.stdout.buffer.write("{} {} {}\n".format(returncode, len(stdout), len(stderr)).encode("utf-8"))
+        sys.stdout.buffer.write(stdout)
+        sys.stdout.buffer.write(stderr)
+        sys.stdout.buffer.flush()
+
+
+if __name__ == "__main__":
+    main()